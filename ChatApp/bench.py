@@ -0,0 +1,161 @@
+"""
+제국 채팅 서버 마이크로 벤치마크
+
+시드를 고정한 임시 DB를 만들어 핫패스를 반복 측정하고 결과를 JSON 으로 남깁니다.
+커밋마다 JSON 을 저장해 두고 --compare 로 비교하면 회귀(중앙값이 느려진 항목)가 드러납니다.
+
+    python bench.py --out before.json
+    python bench.py --out after.json --compare before.json --threshold 0.15
+    python bench.py --sizes 1000,100000 --only ranking
+
+측정 항목
+    get_user / update_db / get_user+update_db 왕복
+    handle_msg (일반 채팅 1건, 보상 + 기록 + 방송 전체)
+    !랭킹 (사용자 수별)
+    on_join (최근 100개 기록 재생 + 호가창 스냅샷)
+    engine_tick (시세 변동 + 은행 이자 일괄 UPDATE + 전원 재평가 + 전송)
+"""
+import argparse, glob, importlib.util, json, os, platform, random, shutil, sqlite3, statistics, subprocess, sys, tempfile, time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+def load_server(work):
+    """임시 폴더를 작업 디렉터리로 삼아 서버 모듈을 불러옵니다. (uploads/DB 가 저장소를 더럽히지 않게)"""
+    os.environ.pop('GEMINI_API_KEY', None)
+    shutil.copytree(os.path.join(HERE, 'templates'), os.path.join(work, 'templates'))
+    os.chdir(work)
+    path = [p for p in glob.glob(os.path.join(HERE, '*.py')) if '채팅방' in p][0]
+    spec = importlib.util.spec_from_file_location('empire_server', path)
+    m = importlib.util.module_from_spec(spec)
+    sys.modules['empire_server'] = m
+    spec.loader.exec_module(m)
+    m.app.root_path = work
+    return m
+
+def seed_db(m, path, users, chats, seed):
+    """사용자 users명, 채팅 chats개를 가진 DB를 만듭니다. 같은 seed 면 항상 같은 내용입니다."""
+    rnd = random.Random(seed)
+    m.DB_FILE = path
+    m.init_db()
+    conn = sqlite3.connect(path)
+    rows = ((f"user{i}", rnd.randint(0, 10**8), rnd.randint(0, 10**7) if rnd.random() < 0.3 else 0, round(rnd.random() * 3, 8)) for i in range(users))
+    conn.executemany("INSERT INTO users (nickname, money, bank_money, btc_amount) VALUES (?, ?, ?, ?)", rows)
+    msgs = ((f"user{rnd.randrange(users)}", f"벤치 메시지 {i} " + "가" * rnd.randint(5, 120), 'chat', '평민') for i in range(chats))
+    conn.executemany("INSERT INTO chats (nickname, msg, type, rank) VALUES (?, ?, ?, ?)", msgs)
+    conn.commit(); conn.close()
+
+def measure(fn, repeat, warmup, budget):
+    """warmup 후 repeat 번(또는 budget 초가 찰 때까지) 실행해 통계를 냅니다."""
+    for _ in range(warmup): fn()
+    times, start = [], time.perf_counter()
+    while len(times) < repeat and (len(times) < 3 or time.perf_counter() - start < budget):
+        t0 = time.perf_counter(); fn(); times.append(time.perf_counter() - t0)
+    times.sort()
+    return {
+        'runs': len(times), 'min_ms': times[0] * 1000, 'median_ms': statistics.median(times) * 1000,
+        'mean_ms': statistics.fmean(times) * 1000, 'p95_ms': times[min(len(times) - 1, int(len(times) * 0.95))] * 1000,
+        'ops_per_sec': len(times) / sum(times),
+    }
+
+def benchmarks(m, work, sizes, args):
+    """(이름, 준비 함수, 측정 함수, 반복 횟수) 목록. 준비 함수는 해당 DB로 전환합니다."""
+    small = os.path.join(work, 'bench_small.sqlite')
+    seed_db(m, small, 1000, 1000, args.seed)
+    use = lambda path: (lambda: (setattr(m, 'DB_FILE', path), m.load_wealth()))  # 자산 배열도 그 DB 기준으로
+    client = m.socketio.test_client(m.app)
+    rnd = random.Random(args.seed)
+
+    def roundtrip():
+        nick = f"user{rnd.randrange(1000)}"
+        m.get_user(nick); m.update_db(nick, 'money', 1, 'bench')
+
+    def chat():
+        client.emit('send_msg', {'nickname': f"user{rnd.randrange(1000)}", 'msg': "벤치마크 채팅 메시지입니다"})
+        client.get_received()
+
+    def ranking():
+        m.command_last.clear()  # !랭킹 쿨다운(heavy) 무시
+        client.emit('send_msg', {'nickname': 'user0', 'msg': "!랭킹"})
+        client.get_received()
+
+    def replay_setup():
+        use(small)()
+        m.message_history.clear(); m.load_history()  # 재생 기록을 앞 항목들의 방송이 아닌 시드 DB 의 최근 채팅으로
+
+    def join():
+        client.emit('join', {'nickname': 'user0'})
+        client.get_received()
+
+    yield 'get_user', use(small), lambda: m.get_user(f"user{rnd.randrange(1000)}"), args.repeat
+    yield 'update_db', use(small), lambda: m.update_db(f"user{rnd.randrange(1000)}", 'money', 1, 'bench'), args.repeat
+    yield 'get_user+update_db', use(small), roundtrip, args.repeat
+    yield 'handle_msg_chat', use(small), chat, args.repeat
+    yield 'on_join_replay', replay_setup, join, args.repeat
+    for n in sizes:
+        if args.only and not any(args.only in f"{k}_{n}" for k in ('ranking', 'engine_tick')): continue  # 안 쓸 DB는 만들지 않음
+        path = os.path.join(work, f"bench_{n}.sqlite")
+        seed_db(m, path, n, 100, args.seed)
+        repeat = max(3, min(args.repeat, 2_000_000 // n))
+        yield f'ranking_{n}', use(path), ranking, repeat
+        yield f'engine_tick_{n}', use(path), m.engine_tick, repeat
+
+def git_rev():
+    try: return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=HERE, text=True, stderr=subprocess.DEVNULL).strip()
+    except Exception: return None
+
+def compare(results, base_path, threshold):
+    """기준 JSON 과 중앙값을 비교해 threshold 이상 느려진 항목 수를 돌려줍니다."""
+    with open(base_path, encoding='utf-8') as f: base = json.load(f)['results']
+    regressions = 0
+    print(f"\n{'항목':<24}{'기준(ms)':>12}{'현재(ms)':>12}{'변화':>9}")
+    for name, r in results.items():
+        if name not in base: continue
+        old, new = base[name]['median_ms'], r['median_ms']
+        ratio = new / old - 1 if old else 0.0
+        flag = "  ⚠️ 회귀" if ratio > threshold else ""
+        regressions += bool(flag)
+        print(f"{name:<24}{old:>12.3f}{new:>12.3f}{ratio:>+9.1%}{flag}")
+    return regressions
+
+def main():
+    ap = argparse.ArgumentParser(description="제국 채팅 서버 마이크로 벤치마크")
+    ap.add_argument('--sizes', default='1000,100000,1000000', help="!랭킹/엔진 측정용 사용자 수 목록")
+    ap.add_argument('--repeat', type=int, default=200)
+    ap.add_argument('--warmup', type=int, default=3)
+    ap.add_argument('--budget', type=float, default=10, help="항목당 최대 측정 시간(초)")
+    ap.add_argument('--seed', type=int, default=1234)
+    ap.add_argument('--only', help="이름에 이 문자열이 들어간 항목만 측정")
+    ap.add_argument('--out', help="결과 JSON 경로")
+    ap.add_argument('--compare', help="비교할 기준 JSON 경로")
+    ap.add_argument('--threshold', type=float, default=0.2, help="중앙값이 이 비율 이상 느려지면 회귀로 표시")
+    args = ap.parse_args()
+    out = os.path.abspath(args.out) if args.out else None
+    base = os.path.abspath(args.compare) if args.compare else None
+    sizes = [int(s) for s in args.sizes.split(',') if s]
+
+    work = tempfile.mkdtemp(prefix='empire_bench_')
+    cwd = os.getcwd()
+    results = {}
+    try:
+        m = load_server(work)
+        for name, setup, fn, repeat in benchmarks(m, work, sizes, args):
+            if args.only and args.only not in name: continue
+            random.seed(args.seed)  # 엔진 시세 변동도 매번 같은 순서
+            setup()
+            results[name] = r = measure(fn, repeat, args.warmup, args.budget)
+            print(f"{name:<24}{r['median_ms']:>10.3f} ms (min {r['min_ms']:.3f}, p95 {r['p95_ms']:.3f}, n={r['runs']})", flush=True)
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(work, ignore_errors=True)
+
+    report = {
+        'meta': {'commit': git_rev(), 'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'python': platform.python_version(),
+                 'sqlite': sqlite3.sqlite_version, 'platform': platform.platform(), 'seed': args.seed, 'sizes': sizes},
+        'results': results,
+    }
+    if out:
+        with open(out, 'w', encoding='utf-8') as f: json.dump(report, f, ensure_ascii=False, indent=2)
+    if base and compare(results, base, args.threshold): sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,62 @@
+"""
+정적 자산 빌드 (Tailwind CSS + socket.io 클라이언트)
+
+assets/src 의 원본을 내용 해시가 붙은 이름으로 assets/dist 에 내보내고, gzip/brotli 압축본과
+manifest.json(원래 이름 -> 해시 이름)을 함께 만듭니다. 서버는 manifest 를 읽어 /assets/<해시 이름> 으로 서빙합니다.
+결과물은 저장소에 포함되어 있으므로 서버 실행에는 이 스크립트가 필요 없고, index.html 의 클래스나 자산을 바꿨을 때만 다시 돌립니다.
+
+    pip install tailwindcss-bin brotli   # tailwindcss 실행 파일 / .br 생성용 (없으면 해당 단계 생략)
+    python build_assets.py
+
+socket.io 클라이언트는 assets/src/socket.io.min.js 에 고정 버전(4.8.1)으로 들어 있습니다.
+"""
+import glob, gzip, hashlib, json, os, shutil, subprocess, sys
+try: import brotli
+except ImportError: brotli = None
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+SRC = os.path.join(HERE, 'assets', 'src')
+DIST = os.path.join(HERE, 'assets', 'dist')
+ASSETS = ['tailwind.css', 'socket.io.min.js']  # manifest 에 올라갈 원래 이름
+
+def build_tailwind(out):
+    """templates/index.html 에서 실제로 쓰는 클래스만 담은 CSS (purge + minify)"""
+    exe = os.environ.get('TAILWIND_BIN') or shutil.which('tailwindcss')
+    if not exe:
+        sys.exit("tailwindcss 실행 파일이 없습니다. (pip install tailwindcss-bin 또는 TAILWIND_BIN 지정)")
+    subprocess.run([exe, '-i', os.path.join(SRC, 'tailwind.css'), '-o', out, '--minify'], cwd=HERE, check=True)
+
+def compress(path, data):
+    # mtime=0 으로 고정해 같은 입력이면 항상 같은 .gz 가 나오게 함
+    with open(path + '.gz', 'wb') as f:
+        with gzip.GzipFile(fileobj=f, mode='wb', compresslevel=9, mtime=0) as gz: gz.write(data)
+    if brotli:
+        with open(path + '.br', 'wb') as f: f.write(brotli.compress(data, quality=11))
+
+def main():
+    os.makedirs(DIST, exist_ok=True)
+    built = os.path.join(DIST, '.tailwind.build.css')
+    build_tailwind(built)
+    manifest = {}
+    for name in ASSETS:
+        src = built if name == 'tailwind.css' else os.path.join(SRC, name)
+        with open(src, 'rb') as f: data = f.read()
+        stem, ext = name.rsplit('.', 1)
+        hashed = f"{stem}.{hashlib.sha256(data).hexdigest()[:12]}.{ext}"
+        out = os.path.join(DIST, hashed)
+        with open(out, 'wb') as f: f.write(data)
+        compress(out, data)
+        manifest[name] = hashed
+        print(f"{name} -> {hashed} ({len(data):,} B, gz {os.path.getsize(out + '.gz'):,} B"
+              + (f", br {os.path.getsize(out + '.br'):,} B)" if brotli else ")"))
+    os.remove(built)
+    # 이전 빌드의 해시 파일 정리
+    keep = set(manifest.values())
+    for p in glob.glob(os.path.join(DIST, '*.*.*')):
+        base = os.path.basename(p)
+        if base.removesuffix('.gz').removesuffix('.br') not in keep: os.remove(p)
+    with open(os.path.join(DIST, 'manifest.json'), 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True); f.write("\n")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,224 @@
+"""
+제국 채팅 서버 부하 발생기
+
+가상 클라이언트 N명이 각각 join 후 정해진 비율로 채팅/명령어/대용량 메시지/업로드를 보내고,
+방송이 되돌아오기까지의 지연(퍼센타일)과 오류율을 측정합니다.
+로컬 서버(127.0.0.1)에만 붙으며, --spawn 을 주면 임시 폴더에서 서버를 직접 띄워 깨끗한 DB로 측정합니다.
+
+    python loadgen.py --spawn --clients 50 --rate 2 --duration 30
+    python loadgen.py --url http://127.0.0.1:5001 --mix chat=60,balance=10,ranking=5,buy=10,large=10,upload=5
+
+필요 패키지: python-socketio[client] (requests, websocket-client)
+"""
+import argparse, glob, json, os, random, shutil, subprocess, sys, tempfile, threading, time, uuid
+import urllib.error, urllib.parse, urllib.request
+import socketio
+
+DEFAULT_MIX = "chat=70,balance=8,ranking=4,buy=8,large=5,upload=5"
+LOOPBACK = ('127.0.0.1', 'localhost', '::1')
+
+def parse_mix(text):
+    mix = {}
+    for part in text.split(','):
+        name, _, weight = part.partition('=')
+        if name.strip() not in ACTIONS: raise SystemExit(f"알 수 없는 동작: {name}")
+        mix[name.strip()] = float(weight or 1)
+    return mix
+
+def percentile(values, p):
+    if not values: return None
+    values = sorted(values)
+    k = (len(values) - 1) * p / 100
+    lo = int(k); hi = min(lo + 1, len(values) - 1)
+    return values[lo] + (values[hi] - values[lo]) * (k - lo)
+
+class Stats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latency = {}   # 동작 -> [초]
+        self.sent = {}
+        self.errors = {}
+
+    def add(self, action, seconds=None, error=None):
+        with self.lock:
+            if error:
+                self.errors.setdefault(action, {}).setdefault(error, 0)
+                self.errors[action][error] += 1
+            else:
+                self.latency.setdefault(action, []).append(seconds)
+
+    def count(self, action):
+        with self.lock: self.sent[action] = self.sent.get(action, 0) + 1
+
+    def report(self, elapsed):
+        rows = {}
+        for action in sorted(set(self.sent) | set(self.errors)):
+            lat = self.latency.get(action, [])
+            errs = sum(self.errors.get(action, {}).values())
+            sent = self.sent.get(action, 0)
+            rows[action] = {
+                'sent': sent, 'ok': len(lat), 'errors': errs, 'error_rate': errs / sent if sent else 0.0,
+                'throughput': len(lat) / elapsed if elapsed else 0.0,
+                **{f'p{p}_ms': (percentile(lat, p) or 0) * 1000 for p in (50, 90, 95, 99)},
+                'max_ms': max(lat) * 1000 if lat else 0, 'error_kinds': self.errors.get(action, {}),
+            }
+        return rows
+
+class SimClient:
+    """가상 사용자 한 명. 보낸 메시지마다 고유 토큰을 붙이고, 방송으로 돌아온 토큰으로 지연을 잽니다."""
+    def __init__(self, idx, args, stats):
+        self.nick = f"{args.prefix}{idx}"
+        self.args, self.stats = args, stats
+        self.pending = {}   # 토큰 -> (동작, 보낸 시각)
+        self.lock = threading.Lock()
+        self.sio = socketio.Client(reconnection=False)
+        self.sio.on('message', self.on_message)
+
+    def on_message(self, d):
+        msg = d.get('msg') or ''
+        if not msg: return
+        now = time.perf_counter()
+        with self.lock:
+            for token in [t for t in self.pending if t in msg]:
+                action, t0 = self.pending.pop(token)
+                self.stats.add(action, now - t0)
+
+    def track(self, action):
+        token = f"lg{uuid.uuid4().hex[:10]}"
+        with self.lock: self.pending[token] = (action, time.perf_counter())
+        return token
+
+    def expire(self, older_than):
+        with self.lock:
+            for token, (action, t0) in list(self.pending.items()):
+                if t0 < older_than:
+                    del self.pending[token]
+                    self.stats.add(action, error='broadcast_timeout')
+
+    def send(self, action, msg):
+        """방송을 기다리지 않는 명령어는 ack 왕복 시간으로 잽니다."""
+        t0 = time.perf_counter()
+        done = threading.Event()
+        def ack(*_):
+            self.stats.add(action, time.perf_counter() - t0); done.set()
+        self.sio.emit('send_msg', {'nickname': self.nick, 'msg': msg}, callback=ack)
+        if not done.wait(self.args.timeout): self.stats.add(action, error='ack_timeout')
+
+    def run(self, deadline, mix):
+        try:
+            self.sio.connect(self.args.url, transports=['websocket'], wait_timeout=self.args.timeout)
+            self.sio.emit('join', {'nickname': self.nick})
+        except Exception as e:
+            self.stats.count('connect'); self.stats.add('connect', error=type(e).__name__)
+            return
+        self.stats.count('connect'); self.stats.add('connect', 0.0)
+        names, weights = list(mix), list(mix.values())
+        next_at = time.perf_counter() + random.random() / self.args.rate  # 시작 시점을 흩뜨림
+        while time.perf_counter() < deadline and self.sio.connected:
+            now = time.perf_counter()
+            if now < next_at: time.sleep(min(next_at - now, 0.05)); continue
+            next_at += random.expovariate(self.args.rate)
+            action = random.choices(names, weights)[0]
+            self.stats.count(action)
+            try: ACTIONS[action](self)
+            except Exception as e: self.stats.add(action, error=type(e).__name__)
+            self.expire(time.perf_counter() - self.args.timeout)
+        time.sleep(min(self.args.timeout, 2))
+        self.expire(float('inf'))
+        self.sio.disconnect()
+
+def act_chat(c):
+    token = c.track('chat')
+    c.sio.emit('send_msg', {'nickname': c.nick, 'msg': f"{token} {random.choice(['안녕', '제국 만세', 'ㅋㅋㅋ', '비트코인 간다'])}"})
+
+def act_large(c):
+    token = c.track('large')  # 500자 초과 -> 파일 변환 후 미리보기에 토큰이 포함되어 방송됨
+    body = "".join(random.choice("가나다라마바사아자차카타파하 ") for _ in range(random.randint(600, 3000)))
+    c.sio.emit('send_msg', {'nickname': c.nick, 'msg': f"{token}\n{body}"})
+
+def act_balance(c): c.send('balance', "!잔액")
+def act_ranking(c): c.send('ranking', "!랭킹")
+def act_buy(c): c.send('buy', f"!매수 비트코인 {random.randint(1, 50)}")
+
+def _http(c, method, path, body=None, headers=None):
+    req = urllib.request.Request(c.args.url.rstrip('/') + path, data=body, method=method, headers=headers or {})
+    with urllib.request.urlopen(req, timeout=c.args.timeout) as r: return json.loads(r.read() or b'{}')
+
+def act_upload(c):
+    """청크 업로드 전체(init -> PUT -> finalize) 시간을 재고, 공유 방송은 별도로 기다리지 않습니다."""
+    data = os.urandom(random.randint(1, c.args.upload_kb) * 1024)
+    t0 = time.perf_counter()
+    try:
+        j = _http(c, 'POST', '/upload/init', json.dumps({'nickname': c.nick, 'filename': f"load_{uuid.uuid4().hex[:6]}.bin", 'size': len(data)}).encode(),
+                  {'Content-Type': 'application/json'})
+        uid, step, off = j['upload_id'], j.get('chunk_size', 1 << 20), 0
+        while off < len(data):
+            off = _http(c, 'PUT', f"/upload/{uid}?offset={off}", data[off:off + step])['offset']
+        _http(c, 'POST', f"/upload/{uid}/finalize", b'')
+        c.stats.add('upload', time.perf_counter() - t0)
+    except urllib.error.HTTPError as e:
+        c.stats.add('upload', error=f"http_{e.code}")
+
+ACTIONS = {'chat': act_chat, 'large': act_large, 'balance': act_balance, 'ranking': act_ranking, 'buy': act_buy, 'upload': act_upload}
+
+def spawn_server(port):
+    """임시 폴더에서 서버를 띄웁니다. (새 DB / 새 uploads, 측정 후 삭제)"""
+    here = os.path.dirname(os.path.abspath(__file__))
+    server = [p for p in glob.glob(os.path.join(here, '*.py')) if os.path.basename(p) not in ('loadgen.py',) and '채팅방' in p][0]
+    work = tempfile.mkdtemp(prefix='empire_load_')
+    env = dict(os.environ, EMPIRE_PORT=str(port), EMPIRE_DEBUG='0')
+    env.pop('GEMINI_API_KEY', None)
+    proc = subprocess.Popen([sys.executable, server], cwd=work, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    url = f"http://127.0.0.1:{port}"
+    for _ in range(100):
+        try:
+            urllib.request.urlopen(url + '/metrics', timeout=1).read(); break
+        except Exception: time.sleep(0.1)
+    else:
+        proc.kill(); raise SystemExit("서버를 띄우지 못했습니다.")
+    return proc, work, url
+
+def main():
+    ap = argparse.ArgumentParser(description="제국 채팅 서버 부하 발생기")
+    ap.add_argument('--url', default='http://127.0.0.1:5001')
+    ap.add_argument('--spawn', action='store_true', help="임시 폴더에 서버를 띄워서 측정")
+    ap.add_argument('--port', type=int, default=5099, help="--spawn 때 쓸 포트")
+    ap.add_argument('--clients', type=int, default=20)
+    ap.add_argument('--rate', type=float, default=1.0, help="클라이언트당 초당 동작 수 (포아송)")
+    ap.add_argument('--duration', type=float, default=20)
+    ap.add_argument('--mix', default=DEFAULT_MIX)
+    ap.add_argument('--upload-kb', type=int, default=256, help="업로드 최대 크기(KB)")
+    ap.add_argument('--timeout', type=float, default=10)
+    ap.add_argument('--prefix', default='부하봇')
+    ap.add_argument('--json', help="결과를 JSON 파일로 저장")
+    args = ap.parse_args()
+    mix = parse_mix(args.mix)
+
+    proc = work = None
+    if args.spawn: proc, work, args.url = spawn_server(args.port)
+    if urllib.parse.urlparse(args.url).hostname not in LOOPBACK:
+        raise SystemExit("로컬 서버(127.0.0.1)에만 부하를 걸 수 있습니다.")
+    stats = Stats()
+    try:
+        clients = [SimClient(i, args, stats) for i in range(args.clients)]
+        t0 = time.perf_counter(); deadline = t0 + args.duration
+        threads = [threading.Thread(target=c.run, args=(deadline, mix), daemon=True) for c in clients]
+        for t in threads: t.start()
+        for t in threads: t.join()
+        elapsed = time.perf_counter() - t0
+    finally:
+        if proc:
+            proc.terminate(); proc.wait(10); shutil.rmtree(work, ignore_errors=True)
+
+    rows = stats.report(elapsed)
+    print(f"{'동작':<10}{'보냄':>8}{'성공':>8}{'오류율':>8}{'처리/s':>9}{'p50':>9}{'p90':>9}{'p99':>9}{'max':>9}  (ms)")
+    for name, r in rows.items():
+        print(f"{name:<10}{r['sent']:>8}{r['ok']:>8}{r['error_rate']:>8.1%}{r['throughput']:>9.1f}"
+              f"{r['p50_ms']:>9.1f}{r['p90_ms']:>9.1f}{r['p99_ms']:>9.1f}{r['max_ms']:>9.1f}")
+        if r['error_kinds']: print(f"{'':<10}오류: {r['error_kinds']}")
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump({'clients': args.clients, 'rate': args.rate, 'duration': elapsed, 'mix': mix, 'results': rows}, f, ensure_ascii=False, indent=2)
+
+if __name__ == '__main__':
+    main()
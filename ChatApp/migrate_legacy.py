@@ -0,0 +1,152 @@
+"""
+예전 버전 DB 통합 도구
+
+ChatApp/ 에 남아 있는 이전 버전들의 SQLite DB(와 루트 서버가 쓰는 DB)를 하나로 합칩니다.
+각 DB 의 스키마를 읽어 있는 열만 옮기고, 같은 닉네임은 열별 충돌 규칙으로 병합하며, 채팅 기록은 그대로 이어 붙입니다.
+행은 SQLite 안에서 BATCH 개씩 (키 구간 단위로) 옮기므로 채팅이 수백만 줄이어도 메모리 사용량이 일정합니다.
+
+    python migrate_legacy.py --dry-run
+    python migrate_legacy.py --out empire_merged.sqlite
+    python migrate_legacy.py --conflict sum --rule is_admin=max --out empire_merged.sqlite a.sqlite b.sqlite
+
+소스는 오래된 것부터 적습니다(기본 목록도 그 순서). 충돌 규칙
+    newest : 나중 소스의 값이 이김 (NULL 이면 기존 값 유지)   [기본]
+    oldest : 먼저 들어온 값을 유지
+    sum    : 더함 (돈/코인)          max / min : 큰 값 / 작은 값
+합친 DB 를 확인한 뒤 서버의 DB_FILE 이름으로 바꿔 두면 됩니다. 나머지 테이블은 서버가 시작할 때 만듭니다.
+"""
+import argparse, os, sqlite3, sys, time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+LEGACY = [  # 오래된 것부터
+    'chat_data.db', 'chat_db.sqlite', 'empire_master.sqlite', 'multiverse_empire.sqlite',
+    'multiverse_empire_ultimate.sqlite', 'multiverse_ultimate_empire.sqlite',
+    os.path.join('..', 'multiverse_empire_ultimate.sqlite'),  # 루트 서버 변종
+]
+BATCH = 5000
+# 서버(init_db)와 같은 스키마. 예전 DB 에만 있는 users 열(is_admin, items ...)은 뒤에 덧붙여 보존합니다.
+USERS_BASE = [('nickname', 'TEXT PRIMARY KEY'), ('money', 'INTEGER DEFAULT 1000'), ('bank_money', 'INTEGER DEFAULT 0'), ('btc_amount', 'REAL DEFAULT 0')]
+CHATS_DDL = "CREATE TABLE chats (id INTEGER PRIMARY KEY AUTOINCREMENT, nickname TEXT, msg TEXT, type TEXT, rank TEXT, time TIMESTAMP DEFAULT CURRENT_TIMESTAMP)"
+CHAT_COLUMNS = ['nickname', 'msg', 'type', 'rank', 'time']
+INDEXES = [
+    "CREATE INDEX IF NOT EXISTS idx_chats_time ON chats (time)",
+    "CREATE INDEX IF NOT EXISTS idx_chats_nick ON chats (nickname, id)",
+]
+RULES = {
+    'newest': "COALESCE(excluded.{c}, users.{c})",
+    'oldest': "COALESCE(users.{c}, excluded.{c})",
+    'sum': "COALESCE(users.{c}, 0) + COALESCE(excluded.{c}, 0)",
+    'max': "MAX(COALESCE(users.{c}, excluded.{c}), COALESCE(excluded.{c}, users.{c}))",
+    'min': "MIN(COALESCE(users.{c}, excluded.{c}), COALESCE(excluded.{c}, users.{c}))",
+}
+
+def q(name):
+    return '"' + name.replace('"', '""') + '"'
+
+def introspect(path):
+    """{테이블: [(열, 선언 타입), ...]} (users/chats 만)"""
+    conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+    try:
+        tables = [r[0] for r in conn.execute("SELECT name FROM sqlite_master WHERE type='table'")]
+        return {t: [(r[1], r[2]) for r in conn.execute(f"PRAGMA table_info({q(t)})")] for t in tables if t in ('users', 'chats')}
+    finally:
+        conn.close()
+
+def key_ranges(conn, table, key, batch):
+    """table 을 key 순서로 batch 개씩 자른 (하한 초과, 상한 이하) 구간들. 키만 읽으므로 메모리는 구간 하나분"""
+    lo = None
+    while True:
+        where = f"WHERE {key} > ?" if lo is not None else ""
+        args = (lo,) if lo is not None else ()
+        hi = conn.execute(f"SELECT max({key}) FROM (SELECT {key} FROM src.{table} {where} ORDER BY {key} LIMIT {batch})", args).fetchone()[0]
+        if hi is None: return
+        yield lo, hi
+        lo = hi
+
+def main():
+    ap = argparse.ArgumentParser(description="예전 버전 SQLite DB 통합")
+    ap.add_argument('sources', nargs='*', help="오래된 것부터. 생략하면 알려진 예전 DB 전부")
+    ap.add_argument('--out', default=os.path.join(HERE, 'empire_merged.sqlite'))
+    ap.add_argument('--force', action='store_true', help="--out 파일이 있으면 지우고 새로 만듦")
+    ap.add_argument('--conflict', choices=RULES, default='newest', help="같은 닉네임의 기본 병합 규칙")
+    ap.add_argument('--rule', action='append', default=[], metavar='열=규칙', help="열별 규칙 (예: money=sum)")
+    ap.add_argument('--batch', type=int, default=BATCH)
+    ap.add_argument('--dry-run', action='store_true', help="스키마와 계획만 출력")
+    args = ap.parse_args()
+
+    sources = [os.path.abspath(p if os.path.isabs(p) else os.path.join(os.getcwd() if args.sources else HERE, p))
+               for p in (args.sources or LEGACY)]
+    sources = [p for p in dict.fromkeys(sources) if os.path.exists(p)]  # 중복/없는 파일 제외
+    if not sources: sys.exit("합칠 DB 가 없습니다.")
+    out = os.path.abspath(args.out)
+    if out in sources: sys.exit("--out 은 소스와 다른 파일이어야 합니다.")
+    rules = {}
+    for r in args.rule:
+        col, _, rule = r.partition('=')
+        if rule not in RULES: sys.exit(f"알 수 없는 규칙: {r}")
+        rules[col] = rule
+
+    schemas = {p: introspect(p) for p in sources}
+    # users 열 = 서버 기본 열 + 예전 DB 에만 있던 열 (처음 본 선언 타입으로)
+    user_cols = dict(USERS_BASE)
+    for s in schemas.values():
+        for col, typ in s.get('users', []):
+            user_cols.setdefault(col, typ or '')
+    for p, s in schemas.items():
+        print(f"{os.path.relpath(p, HERE)}: " + "; ".join(f"{t}({', '.join(c for c, _ in cols)})" for t, cols in s.items()))
+    print(f"-> users({', '.join(user_cols)}), 기본 규칙 {args.conflict}" + (f", 열별 {rules}" if rules else ""))
+    if args.dry_run: return
+
+    if os.path.exists(out):
+        if not args.force: sys.exit(f"{out} 이(가) 이미 있습니다. (--force)")
+        os.remove(out)
+    tmp = out + '.tmp'
+    if os.path.exists(tmp): os.remove(tmp)
+    conn = sqlite3.connect(tmp, isolation_level=None)
+    conn.execute("PRAGMA journal_mode=OFF")  # 새 파일이라 실패하면 통째로 버림
+    conn.execute("PRAGMA synchronous=OFF")
+    conn.execute(f"CREATE TABLE users ({', '.join(f'{q(c)} {t}'.rstrip() for c, t in user_cols.items())})")
+    conn.execute(CHATS_DDL)
+
+    t0 = time.perf_counter()
+    for p in sources:
+        conn.execute("ATTACH DATABASE ? AS src", (p,))
+        s = schemas[p]
+        if 'users' in s:
+            cols = [c for c, _ in s['users'] if c in user_cols]
+            sets = ", ".join(f"{q(c)} = " + RULES[rules.get(c, args.conflict)].format(c=q(c)) for c in cols if c != 'nickname')
+            sql = (f"INSERT INTO users ({', '.join(map(q, cols))}) SELECT {', '.join(map(q, cols))} FROM src.users "
+                   f"WHERE {{where}} ORDER BY nickname ON CONFLICT(nickname) DO " + (f"UPDATE SET {sets}" if sets else "NOTHING"))
+            before = conn.execute("SELECT count(*) FROM users").fetchone()[0]
+            read = 0
+            for lo, hi in key_ranges(conn, 'users', 'nickname', args.batch):
+                where, params = ("nickname > ? AND nickname <= ?", (lo, hi)) if lo is not None else ("nickname <= ?", (hi,))
+                conn.execute("BEGIN")
+                read += conn.execute(sql.format(where=where), params).rowcount
+                conn.execute("COMMIT")
+            added = conn.execute("SELECT count(*) FROM users").fetchone()[0] - before
+            print(f"  users  {os.path.basename(p)}: {read:,}행 (새 {added:,}, 병합 {read - added:,})")
+        if 'chats' in s:
+            cols = [c for c, _ in s['chats'] if c in CHAT_COLUMNS]
+            sql = f"INSERT INTO chats ({', '.join(cols)}) SELECT {', '.join(cols)} FROM src.chats WHERE {{where}} ORDER BY rowid"
+            copied = 0
+            for lo, hi in key_ranges(conn, 'chats', 'rowid', args.batch):
+                where, params = ("rowid > ? AND rowid <= ?", (lo, hi)) if lo is not None else ("rowid <= ?", (hi,))
+                conn.execute("BEGIN")
+                copied += conn.execute(sql.format(where=where), params).rowcount
+                conn.execute("COMMIT")
+            print(f"  chats  {os.path.basename(p)}: {copied:,}행")
+        conn.execute("DETACH DATABASE src")
+
+    for ddl in INDEXES: conn.execute(ddl)
+    conn.execute("ANALYZE")
+    conn.execute("PRAGMA journal_mode=DELETE")
+    ok = conn.execute("PRAGMA quick_check").fetchone()[0]
+    users, chats = conn.execute("SELECT (SELECT count(*) FROM users), (SELECT count(*) FROM chats)").fetchone()
+    conn.close()
+    if ok != 'ok': sys.exit(f"검사 실패: {ok} ({tmp} 보존)")
+    os.replace(tmp, out)
+    print(f"완료: {out} (users {users:,}, chats {chats:,}, {time.perf_counter() - t0:.1f}s)")
+
+if __name__ == '__main__':
+    main()
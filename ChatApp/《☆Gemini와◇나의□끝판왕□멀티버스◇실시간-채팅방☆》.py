@@ -1,17 +1,291 @@
-import sqlite3, os, time, threading, random
-from flask import Flask, render_template, request, send_from_directory
+import sqlite3, os, sys, time, threading, random, json, re, uuid, hashlib, mimetypes, gzip, queue, heapq, bisect
+import collections, functools, hmac, itertools, math, secrets, cProfile, pstats
+from collections import deque
+import numpy as np
+from flask import Flask, render_template, request, send_from_directory, jsonify, g
 from flask_socketio import SocketIO, emit, join_room
 from werkzeug.utils import secure_filename
 
 # --- [설정 및 DB] ---
-PORT = 5001
+PORT = int(os.environ.get('EMPIRE_PORT', 5001))
 UPLOAD_FOLDER = 'uploads'
 DB_FILE = "multiverse_ultimate_empire.sqlite"
 if not os.path.exists(UPLOAD_FOLDER): os.makedirs(UPLOAD_FOLDER)
 
+# --- [메트릭: Prometheus /metrics] ---
+# 기록은 스레드마다 따로 가진 dict 에만 하므로 잠금이 없습니다. (/metrics 요청 때만 모든 스레드 분을 합산)
+# 끝난 스레드의 값은 합산 때 retired 로 옮겨 누적값이 사라지지 않게 합니다.
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+METRICS = {
+    'empire_send_msg_seconds': ('histogram', "send_msg 처리 시간 (command=명령어 또는 chat)"),
+    'empire_sqlite_query_seconds': ('histogram', "SQLite 문장 실행 시간 (op=SQL 동사)"),
+    'empire_sqlite_commit_seconds': ('histogram', "SQLite 커밋 시간"),
+    'empire_emit_total': ('counter', "Socket.IO emit 호출 수"),
+    'empire_emit_fanout_total': ('counter', "emit 으로 전달된 클라이언트 수 합계"),
+    'empire_connected_clients': ('gauge', "현재 접속 중인 Socket.IO 클라이언트 수"),
+    'empire_upload_bytes_total': ('counter', "업로드로 받은 바이트 수"),
+    'empire_gemini_seconds': ('histogram', "Gemini API 호출 시간 (kind=answer/summary)"),
+    'empire_engine_tick_seconds': ('histogram', "배경 엔진 1회 실행 시간"),
+    'empire_revalue_seconds': ('histogram', "시세 변동 후 전원 총자산 재평가 시간"),
+    'empire_wealth_pushes_total': ('counter', "재평가로 보낸 총자산 알림 수"),
+}
+_metric_local = threading.local()
+_metric_shards = []
+_metric_retired = {}
+_metric_shards_lock = threading.Lock()
+connected_clients = 0
+
+def _retire_dead_shards():
+    """끝난 스레드의 조각을 _metric_retired 로 합치고 목록에서 뺍니다. (_metric_shards_lock 을 잡은 채 호출)"""
+    alive = []
+    for t, d in _metric_shards:
+        if t.is_alive(): alive.append((t, d))
+        else:
+            for k, v in list(d.items()): _merge_metric(_metric_retired, k, v)
+    _metric_shards[:] = alive
+
+def _metric_shard():
+    d = getattr(_metric_local, 'd', None)
+    if d is None:
+        d = _metric_local.d = {}
+        with _metric_shards_lock:  # 스레드가 생길 때마다 정리해 두므로 수집이 없어도 목록은 살아있는 스레드 수를 넘지 않음
+            _retire_dead_shards()
+            _metric_shards.append((threading.current_thread(), d))
+    return d
+
+def inc(name, value=1, **labels):
+    d, key = _metric_shard(), (name, tuple(sorted(labels.items())))
+    d[key] = d.get(key, 0) + value
+
+def observe(name, seconds, **labels):
+    d, key = _metric_shard(), (name, tuple(sorted(labels.items())))
+    h = d.get(key)
+    if h is None: h = d[key] = [0] * (len(LATENCY_BUCKETS) + 1) + [0.0]  # 구간별 개수..., 합계
+    h[bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+    h[-1] += seconds
+
+def _merge_metric(dst, key, v):
+    if isinstance(v, list):
+        cur = dst.setdefault(key, [0] * len(v))
+        for i, x in enumerate(v): cur[i] += x
+    else:
+        dst[key] = dst.get(key, 0) + v
+
+def collect_metrics():
+    with _metric_shards_lock:
+        _retire_dead_shards()
+        total = {}
+        for k, v in _metric_retired.items(): _merge_metric(total, k, v)
+        for _, d in _metric_shards:
+            for k, v in list(d.items()): _merge_metric(total, k, v)
+    return total
+
+def _fmt_labels(labels, extra=()):
+    items = [*labels, *extra]
+    if not items: return ""
+    return "{" + ",".join(f'{k}="{str(v).replace(chr(92), chr(92) * 2).replace(chr(34), chr(92) + chr(34))}"' for k, v in items) + "}"
+
+def render_metrics():
+    total = collect_metrics()
+    lines = []
+    for name, (kind, help_text) in METRICS.items():
+        lines += [f"# HELP {name} {help_text}", f"# TYPE {name} {kind}"]
+        for (n, labels), v in sorted(total.items(), key=lambda kv: kv[0][1]):
+            if n != name: continue
+            if kind != 'histogram':
+                lines.append(f"{name}{_fmt_labels(labels)} {v}"); continue
+            acc = 0
+            for le, c in zip(LATENCY_BUCKETS, v):
+                acc += c
+                lines.append(f"{name}_bucket{_fmt_labels(labels, [('le', le)])} {acc}")
+            acc += v[len(LATENCY_BUCKETS)]
+            lines.append(f"{name}_bucket{_fmt_labels(labels, [('le', '+Inf')])} {acc}")
+            lines.append(f"{name}_sum{_fmt_labels(labels)} {v[-1]}")
+            lines.append(f"{name}_count{_fmt_labels(labels)} {acc}")
+    return "\n".join(lines) + "\n"
+
+# --- [트레이싱: 단계별 스팬] ---
+# send_msg 한 건이 trace 하나이고, 그 안의 단계(span)와 SQL 문장이 중첩 노드로 기록됩니다.
+# 진행 중인 trace 는 스레드마다 따로 두므로 잠금이 없고, trace 밖에서 span 은 아무것도 하지 않습니다.
+# 끝난 trace 는 고정 크기 링 버퍼에 쌓이며 /admin/traces 가 가장 느린 N개를 보여줍니다.
+TRACE_RING = deque(maxlen=int(os.environ.get('EMPIRE_TRACE_RING', 1000)))
+TRACE_MAX_SPANS = 200  # trace 하나에 기록할 스팬 수 상한 (SQL 을 반복하는 명령어 대비)
+_trace_local = threading.local()
+
+class span:
+    """with span('단계', 키=값): — 현재 trace 안에 중첩 스팬을 남깁니다."""
+    __slots__ = ('name', 'attrs', 'node', 't0')
+    def __init__(self, name, **attrs):
+        self.name, self.attrs, self.node = name, attrs, None
+
+    def __enter__(self):
+        stack = getattr(_trace_local, 'stack', None)
+        if not stack or _trace_local.count >= TRACE_MAX_SPANS: return self
+        _trace_local.count += 1
+        self.t0 = time.perf_counter()
+        self.node = {'name': self.name, 'start_ms': round((self.t0 - _trace_local.t0) * 1000, 3), 'attrs': self.attrs, 'children': []}
+        stack[-1]['children'].append(self.node)
+        stack.append(self.node)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if self.node is None: return
+        self.node['ms'] = round((time.perf_counter() - self.t0) * 1000, 3)
+        if exc_type: self.node['error'] = exc_type.__name__
+        _trace_local.stack.pop()
+
+class trace(span):
+    """최상위 스팬. 이미 trace 안이면 일반 스팬처럼 중첩됩니다."""
+    __slots__ = ()
+    def __enter__(self):
+        if getattr(_trace_local, 'stack', None): return super().__enter__()
+        self.t0 = _trace_local.t0 = time.perf_counter()
+        _trace_local.count = 0
+        self.node = {'name': self.name, 'time': time.time(), 'attrs': self.attrs, 'children': []}
+        _trace_local.stack = [self.node]
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if self.node is None or _trace_local.stack[0] is not self.node: return super().__exit__(exc_type, exc, tb)
+        self.node['ms'] = round((time.perf_counter() - self.t0) * 1000, 3)
+        if exc_type: self.node['error'] = exc_type.__name__
+        _trace_local.stack = None
+        TRACE_RING.append(self.node)
+
+def trace_leaf(name, seconds, **attrs):
+    """이미 끝난 구간(예: SQL 한 문장)을 현재 trace 에 잎 노드로 붙입니다."""
+    stack = getattr(_trace_local, 'stack', None)
+    if not stack or _trace_local.count >= TRACE_MAX_SPANS: return
+    _trace_local.count += 1
+    start = time.perf_counter() - seconds - _trace_local.t0
+    stack[-1]['children'].append({'name': name, 'start_ms': round(start * 1000, 3), 'ms': round(seconds * 1000, 3), 'attrs': attrs})
+
+# --- [느린 쿼리 로그] ---
+# 모든 문장은 문장 틀(template: 공백 정리 + 리터럴을 ?로 치환)별로 횟수/합계/최대 시간을 모읍니다.
+# SLOW_QUERY_MS 를 넘은 문장은 파라미터와 EXPLAIN QUERY PLAN 결과를 함께 로그로 남기고 최근 목록에 보관합니다.
+SLOW_QUERY_MS = float(os.environ.get('EMPIRE_SLOW_QUERY_MS', 50))
+SLOW_QUERIES = deque(maxlen=200)
+sql_stats = {}   # 문장 틀 -> [횟수, 합계(초), 최대(초), 느린 횟수]
+sql_stats_lock = threading.Lock()
+EXPLAINABLE = ('SELECT', 'INSERT', 'UPDATE', 'DELETE', 'REPLACE', 'WITH')
+
+@functools.lru_cache(maxsize=1024)
+def sql_template(sql):
+    t = re.sub(r"\s+", " ", sql).strip()
+    t = re.sub(r"'(?:[^']|'')*'", "?", t)
+    t = re.sub(r"(?<![\w.])-?\d+(?:\.\d+)?\b", "?", t)
+    return re.sub(r"\(\s*\?(?:\s*,\s*\?)+\s*\)", "(?, ...)", t)
+
+def _short(v, limit=80):
+    r = repr(v)
+    return r if len(r) <= limit else r[:limit] + f"...(+{len(r) - limit})"
+
+commit_order_lock = threading.Lock()
+
+class TimedConnection(sqlite3.Connection):
+    """문장 실행/커밋 시간을 재는 SQLite 연결 (db_connect 로 만듭니다)
+    after_commit 으로 등록한 함수는 트랜잭션이 커밋된 뒤에만 불리고(롤백되면 버림), 커밋과 함께 commit_order_lock 안에서
+    불리므로 여러 연결의 함수가 DB 커밋 순서대로 실행됩니다. (메모리 자산 배열을 DB 와 같은 순서로 갱신)"""
+    def after_commit(self, fn):
+        self.__dict__.setdefault('_after_commit', []).append(fn)
+
+    def _finish(self, committing, end):
+        pending = self.__dict__.pop('_after_commit', None)
+        if not (pending and committing): return end()
+        with commit_order_lock:
+            result = end()
+            for fn in pending: fn()
+        return result
+
+    def commit(self):
+        return self._finish(True, super().commit)
+
+    def rollback(self):
+        return self._finish(False, super().rollback)
+
+    def execute(self, sql, *args):
+        if sql in ('COMMIT', 'ROLLBACK') and '_after_commit' in self.__dict__:
+            return self._finish(sql == 'COMMIT', lambda: self._execute(sql, *args))
+        return self._execute(sql, *args)
+
+    def _execute(self, sql, *args):
+        t0 = time.perf_counter()
+        try: return super().execute(sql, *args)
+        finally: self._timed(sql, time.perf_counter() - t0, args[0] if args else ())
+
+    def executemany(self, sql, *args):
+        t0 = time.perf_counter()
+        try: return super().executemany(sql, *args)
+        finally: self._timed(sql, time.perf_counter() - t0, None)
+
+    def _timed(self, sql, dt, params):
+        op = sql.lstrip().split(None, 1)[0].upper()
+        if op == 'COMMIT': observe('empire_sqlite_commit_seconds', dt)
+        else: observe('empire_sqlite_query_seconds', dt, op=op)
+        trace_leaf('sql', dt, sql=sql.strip()[:120])
+        self._record(sql, op, dt, params)
+
+    def _record(self, sql, op, dt, params):
+        tpl, slow = sql_template(sql), dt * 1000 >= SLOW_QUERY_MS
+        with sql_stats_lock:
+            st = sql_stats.get(tpl)
+            if st is None: st = sql_stats[tpl] = [0, 0.0, 0.0, 0]
+            st[0] += 1; st[1] += dt; st[3] += slow
+            if dt > st[2]: st[2] = dt
+        if not slow: return
+        plan = []
+        if op in EXPLAINABLE and params is not None:
+            try: plan = [r[-1] for r in super().execute("EXPLAIN QUERY PLAN " + sql, params).fetchall()]
+            except sqlite3.Error as e: plan = [f"(plan 실패: {e})"]
+        shown = [_short(v) for v in params.values()] if isinstance(params, dict) else [_short(v) for v in params or ()]
+        SLOW_QUERIES.append({'time': time.time(), 'ms': round(dt * 1000, 3), 'sql': sql.strip(), 'template': tpl,
+                             'params': shown if params is not None else '(executemany)', 'plan': plan})
+        print(f"Slow Query {dt * 1000:.1f}ms: {tpl} params={shown} plan={plan}")
+
+    def __exit__(self, exc_type, exc, tb):
+        t0 = time.perf_counter()
+        try: return self._finish(exc_type is None, lambda: super(TimedConnection, self).__exit__(exc_type, exc, tb))
+        finally:
+            if exc_type is None:
+                dt = time.perf_counter() - t0
+                observe('empire_sqlite_commit_seconds', dt)
+                trace_leaf('sql', dt, sql='COMMIT')
+                self._record('COMMIT', 'COMMIT', dt, None)
+
+def db_connect(**kwargs):
+    conn = sqlite3.connect(DB_FILE, factory=TimedConnection, **kwargs)
+    # WAL 에서는 체크포인트 때만 fsync (전원이 나가면 마지막 커밋 몇 개를 잃을 수 있지만 DB 가 깨지지는 않음)
+    sqlite3.Connection.execute(conn, "PRAGMA synchronous=NORMAL")
+    return conn
+
+# --- [방송 기록: 재접속 이어받기] ---
+# main 방으로 방송되는 message 에는 서버 기동 이후 1씩 늘어나는 id 를 붙이고 최근 RESUME_WINDOW 개를 메모리에 둡니다.
+# 재접속한 클라이언트가 (epoch, last_id) 를 보내면 빠진 구간만, 구간이 창 밖이거나 서버가 재시작됐으면 최근 SNAPSHOT_SIZE 개만 보냅니다.
+# id 부여 + 방송, 그리고 join 의 방 입장 + 기록 재생을 같은 잠금 안에서 하므로 재생 도중의 새 방송은 재생이 끝난 뒤에
+# 나갑니다. 클라이언트는 id 가 늘어나는 순서로만 받으므로 마지막 id 하나로 중복을 걸러도 메시지를 놓치지 않습니다.
+RESUME_WINDOW = int(os.environ.get('EMPIRE_RESUME_WINDOW', 1000))
+SNAPSHOT_SIZE = 100
+SERVER_EPOCH = uuid.uuid4().hex[:12]
+message_history = deque(maxlen=RESUME_WINDOW)
+message_ids = itertools.count(1)
+history_lock = threading.Lock()
+
+class EmpireSocketIO(SocketIO):
+    """emit 마다 전송 횟수와 받는 클라이언트 수(fanout)를 세고, main 방 message 에 id 를 붙여 기록합니다."""
+    def emit(self, event, *args, **kwargs):
+        to = kwargs.get('to') or kwargs.get('room')
+        inc('empire_emit_total', event=event)
+        inc('empire_emit_fanout_total', connected_clients if to in (None, 'main') else 1, event=event)
+        if event == 'message' and to == 'main' and args and isinstance(args[0], dict):
+            with history_lock:
+                msg = {**args[0], 'id': next(message_ids)}
+                message_history.append(msg)
+                return super().emit(event, msg, *args[1:], **kwargs)
+        return super().emit(event, *args, **kwargs)
+
 app = Flask(__name__)
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
-socketio = SocketIO(app, cors_allowed_origins="*", async_mode='threading')
+socketio = EmpireSocketIO(app, cors_allowed_origins="*", async_mode='threading')
 
 crypto_prices = {"비트코인": 50000000}
 noejul_loops = {}
@@ -24,222 +298,1858 @@ try:
     if api_key: client = genai.Client(api_key=api_key)
 except: pass
 
+# --- [Gemini 방별 대화 기억] ---
+GEMINI_MODEL = "gemini-2.0-flash"
+GEMINI_CTX_TOKENS = 2000      # 요청마다 보내는 최근 대화의 토큰 예산
+GEMINI_SUMMARY_EVERY = 20     # 예산 밖으로 밀려난 대화가 이만큼 쌓이면 요약에 접어 넣음
+GEMINI_SUMMARY_CHARS = 1500   # 캐시된 요약의 최대 길이
+gemini_ctx = {}
+gemini_lock = threading.Lock()
+
+def estimate_tokens(text):
+    """토크나이저 없이 싸게 토큰 수를 어림합니다. (영문 약 4자=1토큰, 한글 등은 1자=1토큰)"""
+    ascii_n = sum(1 for ch in text if ord(ch) < 128)
+    return (ascii_n + 3) // 4 + (len(text) - ascii_n) + 1
+
+def _room_ctx(room):
+    ctx = gemini_ctx.get(room)
+    if ctx is None:
+        ctx = gemini_ctx[room] = {'turns': deque(), 'tokens': 0, 'summary': "", 'folded': [], 'summarizing': False}
+    return ctx
+
+def remember_turn(room, who, text):
+    """방의 대화 기억에 한 턴을 추가하고, 토큰 예산을 넘는 오래된 턴은 요약 대기열로 밀어냅니다."""
+    line = f"{who}: {text}"
+    cost = estimate_tokens(line)
+    with gemini_lock:
+        ctx = _room_ctx(room)
+        ctx['turns'].append((line, cost))
+        ctx['tokens'] += cost
+        while ctx['tokens'] > GEMINI_CTX_TOKENS and len(ctx['turns']) > 1:
+            old, old_cost = ctx['turns'].popleft()
+            ctx['tokens'] -= old_cost
+            ctx['folded'].append(old)
+        if len(ctx['folded']) >= GEMINI_SUMMARY_EVERY and not ctx['summarizing']:
+            ctx['summarizing'] = True
+            threading.Thread(target=fold_summary, args=(room,), daemon=True).start()
+
+def fold_summary(room):
+    """밀려난 대화를 기존 요약과 합쳐 새 요약으로 캐시합니다. (채팅 처리와 분리된 백그라운드 작업)"""
+    with gemini_lock:
+        ctx = _room_ctx(room)
+        folded, ctx['folded'] = ctx['folded'], []
+        prev = ctx['summary']
+    summary = None
+    if client is not None:
+        try:
+            prompt = ("다음은 채팅방의 이전 요약과 그 이후 대화입니다. 핵심 인물, 주제, 약속만 남겨 "
+                      f"{GEMINI_SUMMARY_CHARS}자 이내의 한국어 요약으로 갱신하세요.\n\n"
+                      f"[이전 요약]\n{prev}\n\n[대화]\n" + "\n".join(folded))
+            t0 = time.perf_counter()
+            try: summary = client.models.generate_content(model=GEMINI_MODEL, contents=prompt).text
+            finally: observe('empire_gemini_seconds', time.perf_counter() - t0, kind='summary')
+        except Exception as e:
+            print(f"Gemini Summary Error: {e}")
+    if not summary:
+        # API가 없거나 실패하면 최근 내용 위주로 잘라서라도 맥락을 유지
+        summary = (prev + "\n" + "\n".join(folded)).strip()
+    with gemini_lock:
+        ctx['summary'] = summary[-GEMINI_SUMMARY_CHARS:]
+        ctx['summarizing'] = False
+
+def build_gemini_contents(room, prompt):
+    """요약 + 예산 안의 최근 대화 + 이번 질문으로 크기가 제한된 요청 본문을 만듭니다."""
+    with gemini_lock:
+        ctx = _room_ctx(room)
+        summary, turns = ctx['summary'], [line for line, _ in ctx['turns']]
+    parts = ["너는 이 채팅방의 '황실 책사' 봇이다. 아래 대화 맥락을 참고해 마지막 질문에 답하라."]
+    if summary: parts.append(f"[이전 대화 요약]\n{summary}")
+    if turns: parts.append("[최근 대화]\n" + "\n".join(turns))
+    parts.append(f"[질문]\n{prompt}")
+    return "\n\n".join(parts)
+
+# 스키마 변경은 MIGRATIONS 끝에 (다음 버전, 설명, SQL 목록, 트랜잭션 여부) 로만 추가합니다. 이미 배포된 항목은 고치지 않습니다.
+# DB 의 PRAGMA user_version 이 적용된 마지막 버전이며, 시작할 때 그보다 큰 항목만 순서대로 적용합니다.
+# 1번은 버전 관리 이전의 CREATE ... IF NOT EXISTS 묶음이라 기존 DB(버전 0)에 그대로 적용해도 안전합니다.
+MIGRATIONS = [
+    (1, "기본 테이블", [
+        "CREATE TABLE IF NOT EXISTS users (nickname TEXT PRIMARY KEY, money INTEGER DEFAULT 1000, bank_money INTEGER DEFAULT 0, btc_amount REAL DEFAULT 0)",
+        "CREATE TABLE IF NOT EXISTS chats (id INTEGER PRIMARY KEY AUTOINCREMENT, nickname TEXT, msg TEXT, type TEXT, rank TEXT, time TIMESTAMP DEFAULT CURRENT_TIMESTAMP)",
+        # 업로드 파일: 사용자에게 보이는 이름 -> 내용 해시(blob), blob은 참조 횟수로 관리
+        "CREATE TABLE IF NOT EXISTS blobs (hash TEXT PRIMARY KEY, size INTEGER, refs INTEGER DEFAULT 0, last_access REAL DEFAULT 0)",
+        "CREATE INDEX IF NOT EXISTS idx_blobs_access ON blobs (last_access)",
+        "CREATE TABLE IF NOT EXISTS uploads (id INTEGER PRIMARY KEY AUTOINCREMENT, name TEXT UNIQUE, owner TEXT, orig_name TEXT, size INTEGER, mime TEXT, hash TEXT, encoding TEXT, created TIMESTAMP DEFAULT CURRENT_TIMESTAMP)",
+        "CREATE INDEX IF NOT EXISTS idx_uploads_owner ON uploads (owner, id)",
+        "CREATE INDEX IF NOT EXISTS idx_uploads_hash ON uploads (hash)",
+        # 거래소: 수량(qty/remaining)은 1e-8 단위 정수, reserved 는 매수 주문에 묶어둔 현금
+        "CREATE TABLE IF NOT EXISTS orders (id INTEGER PRIMARY KEY AUTOINCREMENT, nickname TEXT, asset TEXT, side TEXT, price INTEGER, qty INTEGER, remaining INTEGER, reserved INTEGER DEFAULT 0, status TEXT DEFAULT 'open', created TIMESTAMP DEFAULT CURRENT_TIMESTAMP)",
+        "CREATE INDEX IF NOT EXISTS idx_orders_open ON orders (status, asset)",
+        "CREATE TABLE IF NOT EXISTS trades (id INTEGER PRIMARY KEY AUTOINCREMENT, asset TEXT, price INTEGER, qty INTEGER, buy_order INTEGER, sell_order INTEGER, time TIMESTAMP DEFAULT CURRENT_TIMESTAMP)",
+    ], True),
+    (2, "chats 시간/닉네임 색인 (기록 재생, 사용자별 조회)", [
+        "CREATE INDEX IF NOT EXISTS idx_chats_time ON chats (time)",
+        "CREATE INDEX IF NOT EXISTS idx_chats_nick ON chats (nickname, id)",
+    ], True),
+    # WAL: 읽기가 쓰기를 막지 않고 커밋이 로그 추가만으로 끝남 (트랜잭션 안에서는 바꿀 수 없음)
+    (3, "WAL 저널", ["PRAGMA journal_mode=WAL"], False),
+    # 잔액 원장: 증감(amount)은 NUMERIC 이라 현금은 정수, 코인은 실수 그대로 남음. 시각은 유닉스 초
+    # 기존 사용자의 현재 잔액은 원장 위치 0 의 기준 스냅샷이 됨 (그 이전 시점은 재구성 불가)
+    (4, "잔액 원장 + 스냅샷", [
+        "CREATE TABLE IF NOT EXISTS ledger (id INTEGER PRIMARY KEY AUTOINCREMENT, nickname TEXT, col TEXT, amount NUMERIC, reason TEXT, time REAL)",
+        "CREATE INDEX IF NOT EXISTS idx_ledger_nick ON ledger (nickname, id)",
+        "CREATE TABLE IF NOT EXISTS balance_snapshots (ledger_id INTEGER, nickname TEXT, money INTEGER, bank_money INTEGER, btc_amount REAL, time REAL, PRIMARY KEY (nickname, ledger_id))",
+        "CREATE INDEX IF NOT EXISTS idx_snapshots_ledger ON balance_snapshots (ledger_id)",
+        "INSERT OR IGNORE INTO balance_snapshots SELECT 0, nickname, money, bank_money, btc_amount, (julianday('now') - 2440587.5) * 86400.0 FROM users",
+    ], True),
+]
+
 def init_db():
-    with sqlite3.connect(DB_FILE) as conn:
-        conn.execute("CREATE TABLE IF NOT EXISTS users (nickname TEXT PRIMARY KEY, money INTEGER DEFAULT 1000, bank_money INTEGER DEFAULT 0, btc_amount REAL DEFAULT 0)")
-        conn.execute("CREATE TABLE IF NOT EXISTS chats (id INTEGER PRIMARY KEY AUTOINCREMENT, nickname TEXT, msg TEXT, type TEXT, rank TEXT, time TIMESTAMP DEFAULT CURRENT_TIMESTAMP)")
+    """user_version 보다 새 마이그레이션을 순서대로 적용합니다. 여러 프로세스가 동시에 시작해도 BEGIN IMMEDIATE 로 한 번씩만 적용됩니다."""
+    conn = db_connect(isolation_level=None, timeout=30)
+    try:
+        for version, name, statements, in_tx in MIGRATIONS:
+            if in_tx: conn.execute("BEGIN IMMEDIATE")
+            if conn.execute("PRAGMA user_version").fetchone()[0] >= version:
+                if in_tx: conn.execute("ROLLBACK")
+                continue
+            try:
+                for sql in statements: conn.execute(sql)
+                conn.execute(f"PRAGMA user_version = {version}")
+                if in_tx: conn.execute("COMMIT")
+            except Exception:
+                if in_tx: conn.execute("ROLLBACK")
+                raise
+            print(f"DB Migration {version}: {name}")
+    finally:
+        conn.close()
 init_db()
 
+def load_history():
+    """재시작 직후에도 스냅샷을 줄 수 있게 최근 채팅으로 방송 기록을 채웁니다."""
+    with db_connect() as conn:
+        rows = conn.execute("SELECT nickname, msg, type, rank FROM chats ORDER BY id DESC LIMIT ?", (SNAPSHOT_SIZE,)).fetchall()
+    with history_lock:
+        for nickname, msg, typ, rank in reversed(rows):
+            message_history.append({'nickname': nickname, 'msg': msg, 'type': typ, 'rank': rank, 'id': next(message_ids)})
+load_history()
+
 def get_user(nick):
-    with sqlite3.connect(DB_FILE) as conn:
+    with db_connect() as conn:
         conn.row_factory = sqlite3.Row
         u = conn.execute("SELECT * FROM users WHERE nickname = ?", (nick,)).fetchone()
         if not u:
-            conn.execute("INSERT INTO users (nickname) VALUES (?)", (nick,))
+            ensure_user(conn, nick)
             u = conn.execute("SELECT * FROM users WHERE nickname = ?", (nick,)).fetchone()
         return dict(u)
 
-def update_db(nick, field, amount):
-    with sqlite3.connect(DB_FILE) as conn:
-        conn.execute(f"UPDATE users SET {field} = {field} + ? WHERE nickname = ?", (amount, nick))
+def update_db(nick, field, amount, reason):
+    update_balances(nick, {field: amount}, reason)
+
+def update_balances(nick, changes, reason, require=None):
+    """{열: 증감} 을 UPDATE 한 번으로 반영하고 같은 트랜잭션에서 원장에 남깁니다. (예: 저금 = 현금 -x, 은행 +x)
+    require=(열, 최소값) 이면 확인과 차감을 같은 UPDATE 에서 해서 동시 요청에도 잔액이 음수가 되지 않습니다. 반영 여부를 돌려줌"""
+    sql, args = f"UPDATE users SET {', '.join(f'{c} = {c} + ?' for c in changes)} WHERE nickname = ?", (*changes.values(), nick)
+    if require: sql += f" AND {require[0]} >= ?"; args += (require[1],)
+    with db_connect() as conn:
+        ensure_user(conn, nick)  # 아직 없는 닉네임(예: 업로드 보상)이면 먼저 가입시켜 원장과 잔액이 어긋나지 않게
+        if not conn.execute(sql, args).rowcount: return False
+        record_ledger(conn, [(nick, c, a, reason) for c, a in changes.items()])
+    return True
+
+# --- [잔액 원장 / 스냅샷] ---
+# users 잔액을 바꾸는 모든 곳은 같은 트랜잭션에서 record_ledger 로 (닉네임, 열, 증감, 사유) 를 한 번에 남깁니다.
+# 원장은 추가만 하며, LEDGER_SNAPSHOT_EVERY 마다 그 사이 원장에 나온 사용자들의 잔액을 원장 위치와 함께 스냅샷으로 찍습니다.
+# 어떤 시점의 잔액이든 그 이전 마지막 스냅샷 + 이후 원장(최대 스냅샷 한 주기분)으로 다시 계산할 수 있습니다.
+LEDGER_SNAPSHOT_EVERY = int(os.environ.get('EMPIRE_LEDGER_SNAPSHOT_EVERY', 3600))  # 초, 0 이면 자동 스냅샷 끔
+BALANCE_COLUMNS = ('money', 'bank_money', 'btc_amount')
+
+def record_ledger(conn, rows):
+    """rows: (닉네임, 열, 증감, 사유) 목록. 잔액 UPDATE 와 같은 conn(트랜잭션)에서 부릅니다. 0 인 증감은 건너뜀"""
+    now = time.time()
+    rows = [(n, c, a, r, now) for n, c, a, r in rows if a]
+    conn.executemany("INSERT INTO ledger (nickname, col, amount, reason, time) VALUES (?, ?, ?, ?, ?)", rows)
+    if rows: conn.after_commit(functools.partial(wealth_apply, rows))  # 롤백되면 배열은 그대로
+
+def ensure_user(conn, nick):
+    """없는 사용자면 만들고 기본 지급액을 원장에 남깁니다."""
+    if conn.execute("INSERT OR IGNORE INTO users (nickname) VALUES (?)", (nick,)).rowcount:
+        row = conn.execute("SELECT money, bank_money, btc_amount FROM users WHERE nickname = ?", (nick,)).fetchone()
+        record_ledger(conn, [(nick, c, a, 'signup') for c, a in zip(BALANCE_COLUMNS, row)])
+
+def snapshot_balances(everyone=False):
+    """지난 스냅샷 이후 원장에 나온 사용자(everyone 이면 전원)의 현재 잔액을 지금의 원장 위치로 남깁니다. (원장 위치, 사용자 수)"""
+    conn = db_connect(timeout=30, isolation_level=None)
+    try:
+        conn.execute("BEGIN IMMEDIATE")  # 그 사이 잔액/원장 쓰기가 끼어들지 않게
+        last = conn.execute("SELECT COALESCE(MAX(ledger_id), 0) FROM balance_snapshots").fetchone()[0]
+        head = conn.execute("SELECT COALESCE(MAX(id), 0) FROM ledger").fetchone()[0]
+        sql = "INSERT OR REPLACE INTO balance_snapshots SELECT ?, nickname, money, bank_money, btc_amount, ? FROM users"
+        if everyone: n = conn.execute(sql, (head, time.time())).rowcount
+        elif head > last:
+            n = conn.execute(sql + " WHERE nickname IN (SELECT nickname FROM ledger WHERE id > ? AND id <= ?)", (head, time.time(), last, head)).rowcount
+        else: n = 0
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+    finally:
+        conn.close()
+    return head, n
+
+def balance_at(nick, when=None):
+    """when(유닉스 시각, 기본 지금) 시점의 잔액. 원장이 생기기 전이라 알 수 없으면 None"""
+    when = time.time() if when is None else when
+    with db_connect() as conn:
+        snap = conn.execute("SELECT ledger_id, money, bank_money, btc_amount FROM balance_snapshots WHERE nickname = ? AND time <= ? "
+                            "ORDER BY ledger_id DESC LIMIT 1", (nick, when)).fetchone()
+        if snap: start, bal = snap[0], dict(zip(BALANCE_COLUMNS, snap[1:]))
+        elif conn.execute("SELECT 1 FROM balance_snapshots WHERE nickname = ? AND ledger_id = 0", (nick,)).fetchone(): return None
+        else: start, bal = 0, dict.fromkeys(BALANCE_COLUMNS, 0)  # 원장 이후 가입: 0 에서 signup 부터 재생
+        replayed = 0
+        for col, amount, n in conn.execute("SELECT col, SUM(amount), COUNT(*) FROM ledger WHERE nickname = ? AND id > ? AND time <= ? GROUP BY col",
+                                           (nick, start, when)):
+            bal[col] += amount; replayed += n
+    return {**bal, 'snapshot_ledger_id': start, 'replayed': replayed}
+
+def ledger_snapshot_loop():
+    while True:
+        time.sleep(LEDGER_SNAPSHOT_EVERY)
+        try:
+            head, n = snapshot_balances()
+            if n: print(f"Ledger snapshot: {n} users @ {head}")
+        except Exception as e:
+            print(f"Ledger Snapshot Error: {e}")
+
+if LEDGER_SNAPSHOT_EVERY > 0: threading.Thread(target=ledger_snapshot_loop, daemon=True).start()
+
+# --- [자산 일괄 재평가] ---
+# 사용자별 (현금, 은행, 코인) 을 열 단위 NumPy 배열로 메모리에 들고 있다가, 시세가 바뀔 때마다 전원의 총자산을
+# 연산 한 번으로 다시 계산해 접속 중이고 마지막으로 알려준 값에서 REVALUE_THRESHOLD 비율 넘게 변했거나
+# 등급이 바뀐 사용자에게만 'wealth' 를 보냅니다. 배열은 record_ledger(모든 잔액 변경이 지나감) 와 이자 계산이 함께 갱신하고,
+# 둘 다 커밋이 성공한 뒤에만(after_commit) 배열에 반영되고, 원장을 거치지 않는 가져오기 뒤에는 load_wealth 로 다시 읽습니다.
+REVALUE_THRESHOLD = float(os.environ.get('EMPIRE_REVALUE_THRESHOLD', 0.01))
+RANK_TIERS = [(200000000, "멀티버스 지배자"), (10000000, "초월자")]  # 높은 순, 나머지는 평민
+wealth_lock = threading.Lock()
+wealth = {'index': {}, 'nicks': [], 'cols': np.zeros((len(BALANCE_COLUMNS), 0)), 'pushed': np.zeros(0, np.int64), 'online': np.zeros(0, np.int32)}
+online_sids = {}  # sid -> 닉네임
+
+def rank_of(total):
+    return next((name for bound, name in RANK_TIERS if total >= bound), "평민")
+
+def _tier(totals):
+    return np.searchsorted(np.array([b for b, _ in reversed(RANK_TIERS)]), totals, side='right')
+
+def _wealth_row(nick):
+    """닉네임의 배열 행 번호 (없으면 추가, 자리가 모자라면 두 배로 늘림). wealth_lock 안에서 부릅니다."""
+    i = wealth['index'].get(nick)
+    if i is None:
+        i = wealth['index'][nick] = len(wealth['nicks'])
+        wealth['nicks'].append(nick)
+        cap = wealth['cols'].shape[1]
+        if i >= cap:
+            grow = max(1024, cap)
+            wealth['cols'] = np.concatenate([wealth['cols'], np.zeros((len(BALANCE_COLUMNS), grow))], axis=1)
+            wealth['pushed'] = np.concatenate([wealth['pushed'], np.zeros(grow, np.int64)])
+            wealth['online'] = np.concatenate([wealth['online'], np.zeros(grow, np.int32)])
+    return i
+
+def wealth_interest():
+    """engine_tick 의 이자 UPDATE 와 같은 계산 (bank_money > 0 인 사람에게 int(bank_money * 0.001))"""
+    with wealth_lock:
+        money, bank, _ = wealth['cols'][:, :len(wealth['nicks'])]
+        money += np.where(bank > 0, np.trunc(bank * 0.001), 0)
+
+def wealth_apply(rows):
+    """원장 행 (닉네임, 열, 증감, ...) 을 배열에 더합니다."""
+    with wealth_lock:
+        for nick, col, amount, *_ in rows:
+            wealth['cols'][BALANCE_COLUMNS.index(col), _wealth_row(nick)] += amount
+
+def load_wealth():
+    """DB 의 잔액으로 배열을 다시 채웁니다. BEGIN IMMEDIATE 로 진행 중인 잔액 쓰기가 끝난 뒤의 값을 읽고,
+    commit_order_lock 으로 이미 커밋된 트랜잭션의 after_commit 반영까지 끝난 뒤에 바꿔 끼웁니다. (같은 변경을 두 번 더하지 않게)
+    순서는 DB 잠금 → commit_order_lock: 이 락을 잡은 쪽은 이미 커밋해 DB 잠금을 놓았으므로 서로 기다리지 않습니다."""
+    conn = db_connect(timeout=30, isolation_level=None)
+    try:
+        conn.execute("BEGIN IMMEDIATE")
+        with commit_order_lock, wealth_lock:
+            rows = conn.execute(f"SELECT nickname, {', '.join(BALANCE_COLUMNS)} FROM users").fetchall()
+            # 접속 상태와 마지막으로 알려준 값은 DB 에 없으므로 옮겨 담음
+            keep = {nick: (wealth['online'][i], wealth['pushed'][i]) for nick, i in wealth['index'].items() if wealth['online'][i]}
+            size, cap = len(rows), max(1024, len(rows) * 2)
+            wealth['nicks'] = [r[0] for r in rows]
+            wealth['index'] = {nick: i for i, nick in enumerate(wealth['nicks'])}
+            wealth['cols'] = np.zeros((len(BALANCE_COLUMNS), cap))
+            if rows: wealth['cols'][:, :size] = np.array([r[1:] for r in rows], dtype=float).T
+            wealth['pushed'], wealth['online'] = np.zeros(cap, np.int64), np.zeros(cap, np.int32)
+            for nick, (count, total) in keep.items():
+                i = _wealth_row(nick)
+                wealth['online'][i], wealth['pushed'][i] = count, total
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+    finally:
+        conn.close()
+
+def wealth_totals(price):
+    """전원의 총자산 (asset_values 와 같은 계산: 현금 + 은행 + int(코인 × 시세))"""
+    money, bank, btc = wealth['cols'][:, :len(wealth['nicks'])]
+    return (money + bank + np.trunc(btc * price)).astype(np.int64)
+
+def revalue(price):
+    """시세 price 로 전원을 재평가해 알려줄 (닉네임, 총자산) 목록을 돌려주고, 그 값을 알려준 값으로 기록합니다."""
+    t0 = time.perf_counter()
+    with wealth_lock:
+        n = len(wealth['nicks'])
+        totals, pushed, online = wealth_totals(price), wealth['pushed'][:n], wealth['online'][:n]
+        moved = (np.abs(totals - pushed) > REVALUE_THRESHOLD * np.abs(pushed)) | (_tier(totals) != _tier(pushed))
+        idx = np.flatnonzero((online > 0) & moved)
+        pushed[idx] = totals[idx]
+        updates = [(wealth['nicks'][i], int(totals[i])) for i in idx]
+    observe('empire_revalue_seconds', time.perf_counter() - t0)
+    return updates
+
+def wealth_online(sid, nick):
+    """접속한 사용자를 등록하고 현재 총자산을 알려준 값으로 돌려줍니다."""
+    with wealth_lock:
+        old = online_sids.get(sid)
+        i = _wealth_row(nick)
+        if old != nick:
+            if old is not None: wealth['online'][wealth['index'][old]] -= 1
+            online_sids[sid] = nick
+            wealth['online'][i] += 1
+        money, bank, btc = wealth['cols'][:, i]
+        wealth['pushed'][i] = total = int(money + bank + int(btc * crypto_prices['비트코인']))
+        return total
+
+def wealth_offline(sid):
+    with wealth_lock:
+        nick = online_sids.pop(sid, None)
+        if nick is not None: wealth['online'][wealth['index'][nick]] -= 1
+
+def push_wealth(updates):
+    if not updates: return
+    by_nick = dict(updates)
+    with wealth_lock: sids = [(sid, nick) for sid, nick in online_sids.items() if nick in by_nick]
+    for sid, nick in sids:
+        socketio.emit('wealth', {'total_asset': by_nick[nick], 'rank': rank_of(by_nick[nick])}, to=sid)
+    inc('empire_wealth_pushes_total', len(updates))
+
+load_wealth()
 
 def broadcast_news(msg):
     """실시간 제국 속보를 전송합니다."""
     socketio.emit('message', {'msg': f"🚨 [제국 속보] {msg}", 'type': 'system'}, room='main')
 
 # 수정된 배경 엔진 로직
+def engine_tick():
+    """엔진 1회분 (시세 변동 + 이자 + 전송). 벤치마크(bench.py)도 이 함수를 직접 부릅니다."""
+    with db_connect(timeout=10) as conn: # timeout 추가
+        # 1. 비트코인 시세 변동
+        change = random.uniform(0.95, 1.05)
+        crypto_prices["비트코인"] = int(crypto_prices["비트코인"] * change)
+        
+        # 2. 은행 이자 '돈 복사' (일괄 업데이트로 속도 향상, 원장도 같은 트랜잭션에서 한 문장으로 먼저 기록)
+        conn.execute("INSERT INTO ledger (nickname, col, amount, reason, time) SELECT nickname, 'money', CAST(bank_money * 0.001 AS INTEGER), 'interest', ? "
+                     "FROM users WHERE CAST(bank_money * 0.001 AS INTEGER) > 0", (time.time(),))
+        conn.execute("UPDATE users SET money = money + CAST(bank_money * 0.001 AS INTEGER) WHERE bank_money > 0")
+        conn.after_commit(wealth_interest)
+        conn.commit()
+        
+        # 3. 실시간 전송
+        socketio.emit('price_update', {'btc': crypto_prices["비트코인"]}, room='main')
+
+        # 4. 바뀐 시세로 전원 재평가 후 눈에 띄게 변한 접속자에게만 총자산 알림
+        push_wealth(revalue(crypto_prices["비트코인"]))
+        
+        if change > 1.04:
+            broadcast_news(f"📈 비트코인 폭등! 현재가: {crypto_prices['비트코인']:,}₩")
+        elif change < 0.96:
+            broadcast_news(f"📉 비트코인 대폭락! 현재가: {crypto_prices['비트코인']:,}₩")
+
 def empire_background_engine():
-    global crypto_prices
     while True:
         time.sleep(60)
+        t0 = time.perf_counter()
         try:
-            with sqlite3.connect(DB_FILE, timeout=10) as conn: # timeout 추가
-                # 1. 비트코인 시세 변동
-                change = random.uniform(0.95, 1.05)
-                crypto_prices["비트코인"] = int(crypto_prices["비트코인"] * change)
-                
-                # 2. 은행 이자 '돈 복사' (일괄 업데이트로 속도 향상)
-                conn.execute("UPDATE users SET money = money + CAST(bank_money * 0.001 AS INTEGER) WHERE bank_money > 0")
-                conn.commit()
-                
-                # 3. 실시간 전송
-                socketio.emit('price_update', {'btc': crypto_prices["비트코인"]}, room='main')
-                
-                if change > 1.04:
-                    broadcast_news(f"📈 비트코인 폭등! 현재가: {crypto_prices['비트코인']:,}₩")
-                elif change < 0.96:
-                    broadcast_news(f"📉 비트코인 대폭락! 현재가: {crypto_prices['비트코인']:,}₩")
+            engine_tick()
         except Exception as e:
             print(f"Engine Error: {e}")
+        observe('empire_engine_tick_seconds', time.perf_counter() - t0)
 
 threading.Thread(target=empire_background_engine, daemon=True).start()
 
+# --- [정적 자산 / 첫 화면] ---
+# CSS/JS 는 build_assets.py 가 만든 내용 해시 이름(assets/dist)으로만 서빙하므로 1년 immutable 캐시가 안전합니다.
+# .br/.gz 압축본을 미리 만들어 두어 요청마다 압축하지 않고, 받을 수 있는 인코딩 중 가장 작은 것을 보냅니다.
+# index.html 은 처음 한 번만 렌더링해 (원본, gzip) 바이트를 들고 있다가 ETag 재검증(304)으로 답합니다.
+ASSET_FOLDER = os.path.join(app.root_path, 'assets', 'dist')
+ASSET_ENCODINGS = (('br', '.br'), ('gzip', '.gz'))  # 선호 순서
+
+def _load_assets():
+    """manifest(원래 이름 -> 해시 이름)와 해시 이름별로 준비된 압축본 목록"""
+    try:
+        with open(os.path.join(ASSET_FOLDER, 'manifest.json'), encoding='utf-8') as f: manifest = json.load(f)
+    except (OSError, ValueError) as e:
+        print(f"Asset Manifest Error: {e}")
+        return {}, {}
+    variants = {h: [(enc, ext) for enc, ext in ASSET_ENCODINGS if os.path.exists(os.path.join(ASSET_FOLDER, h + ext))]
+                for h in manifest.values()}
+    return manifest, variants
+ASSET_MANIFEST, ASSET_VARIANTS = _load_assets()
+index_page = {}
+
+@app.template_global()
+def asset_url(name):
+    return f"/assets/{ASSET_MANIFEST.get(name, name)}"
+
+@app.route('/assets/<name>')
+def asset(name):
+    if name not in ASSET_VARIANTS: return jsonify(error='not found'), 404
+    enc, ext = next(((e, x) for e, x in ASSET_VARIANTS[name] if request.accept_encodings[e] > 0), (None, ''))
+    etag = f"{name}-{enc}" if enc else name
+    if request.if_none_match.contains_weak(etag):
+        resp = app.response_class(status=304)
+    else:
+        resp = send_from_directory(ASSET_FOLDER, name + ext, mimetype=mimetypes.guess_type(name)[0], etag=etag,
+                                   conditional=True, max_age=DOWNLOAD_MAX_AGE)
+        if enc: resp.headers['Content-Encoding'] = enc
+    resp.vary.add('Accept-Encoding')
+    return _immutable(resp, etag)
+
 @app.route('/')
-def index(): return render_template('index.html')
+def index():
+    page = index_page.get('main')
+    if page is None:
+        html = render_template('index.html').encode('utf-8')
+        page = index_page['main'] = (html, gzip.compress(html, 9, mtime=0), hashlib.sha256(html).hexdigest()[:16])
+    html, gz, digest = page
+    gz_ok = request.accept_encodings['gzip'] > 0
+    etag = f"{digest}-gzip" if gz_ok else digest
+    if request.if_none_match.contains_weak(etag):
+        resp = app.response_class(status=304)
+    else:
+        resp = app.response_class(gz if gz_ok else html, mimetype='text/html')
+        if gz_ok: resp.headers['Content-Encoding'] = 'gzip'
+    resp.set_etag(etag)
+    resp.cache_control.no_cache = True  # 배포마다 자산 해시가 바뀌므로 첫 화면은 항상 재검증
+    resp.vary.add('Accept-Encoding')
+    return resp
+
+# --- [다운로드: ETag / 조건부 요청 / Range / 장기 캐시] ---
+# blob은 내용 해시로 저장되므로 한 번 공유된 이름의 내용은 절대 바뀌지 않습니다.
+# 따라서 해시가 그대로 강한 ETag가 되고, 브라우저/프록시가 1년간 재검증 없이 캐시해도 안전합니다.
+DOWNLOAD_MAX_AGE = 365 * 24 * 3600
+# nginx/Apache 뒤에서 돌릴 때 EMPIRE_X_SENDFILE=1 이면 파일 전송을 웹서버(sendfile)에 넘깁니다.
+# 그 외에는 WSGI 서버가 제공하는 wsgi.file_wrapper(가능하면 sendfile)로 전송됩니다.
+app.config['USE_X_SENDFILE'] = os.environ.get('EMPIRE_X_SENDFILE') == '1'
+
+def _immutable(resp, etag):
+    resp.set_etag(etag)
+    resp.cache_control.public = True
+    resp.cache_control.max_age = DOWNLOAD_MAX_AGE
+    resp.cache_control.immutable = True
+    return resp
+
+def _gunzip_stream(path):
+    with gzip.open(path, 'rb') as f:
+        for buf in iter(lambda: f.read(CHUNK_BUF), b''): yield buf
 
 @app.route('/uploads/<path:filename>')
-def download(filename): return send_from_directory(app.config['UPLOAD_FOLDER'], filename)
+def download(filename):
+    with db_connect() as conn:
+        row = conn.execute("SELECT hash, orig_name, mime, encoding FROM uploads WHERE name = ?", (filename,)).fetchone()
+    if row:
+        digest, orig_name, mime, enc = row
+        touch_blob(digest)
+        # gzip으로 저장된 텍스트: 받을 수 있는 클라이언트엔 그대로, 아니면 즉석에서 풀어서 보냄
+        # 두 표현은 바이트가 다르므로 ETag도 따로 둡니다.
+        gz_ok = enc == 'gzip' and request.accept_encodings['gzip'] > 0
+        etag = digest if enc is None or gz_ok else f"{digest}-identity"
+        # 재다운로드는 DB 조회만으로 304 처리 (파일을 열거나 읽지 않음)
+        if request.if_none_match.contains_weak(etag):
+            resp = _immutable(app.response_class(status=304), etag)
+        elif enc == 'gzip' and not gz_ok:
+            resp = _immutable(app.response_class(_gunzip_stream(blob_path(digest)), mimetype=mime), etag)
+        else:
+            # Range / If-Modified-Since / If-Range 는 send_file(conditional=True)이 처리
+            resp = send_from_directory(BLOB_FOLDER, blob_relpath(digest), download_name=orig_name, etag=etag,
+                                       conditional=True, max_age=DOWNLOAD_MAX_AGE)
+            resp = _immutable(resp, etag)
+            if gz_ok: resp.headers['Content-Encoding'] = 'gzip'
+        if enc: resp.vary.add('Accept-Encoding')
+        return resp
+    return send_from_directory(app.config['UPLOAD_FOLDER'], filename)  # 해시 저장 이전의 파일
+
+@app.route('/uploads/<path:filename>', methods=['DELETE'])
+def delete_file(filename):
+    """올린 사람만 자기 공유 파일을 지울 수 있습니다."""
+    nick = request.args.get('nickname') or (request.get_json(silent=True) or {}).get('nickname')
+    with db_connect() as conn:
+        row = conn.execute("SELECT owner FROM uploads WHERE name = ?", (filename,)).fetchone()
+    if not row: return jsonify(error='not found'), 404
+    if row[0] != nick: return jsonify(error='forbidden'), 403
+    delete_upload(filename)
+    return '', 204
+
+@app.route('/api/uploads')
+def list_uploads():
+    """채팅에 공유된 파일 목록 (최신순, id 커서 기반 페이지). 폴더를 훑지 않고 색인만 읽습니다.
+    ?before=<id>&limit=50&owner=<닉네임>"""
+    limit = max(1, min(request.args.get('limit', 50, type=int), 200))
+    before = request.args.get('before', type=int)
+    owner = request.args.get('owner')
+    sql, args = "SELECT id, name, owner, orig_name, size, mime, hash, created FROM uploads WHERE 1=1", []
+    if before is not None: sql += " AND id < ?"; args.append(before)
+    if owner: sql += " AND owner = ?"; args.append(owner)
+    sql += " ORDER BY id DESC LIMIT ?"; args.append(limit)
+    with db_connect() as conn:
+        conn.row_factory = sqlite3.Row
+        items = [dict(r) for r in conn.execute(sql, args).fetchall()]
+    for it in items: it['url'] = f"{request.host_url.rstrip('/')}/uploads/{it['name']}"
+    return jsonify(items=items, next_before=items[-1]['id'] if len(items) == limit else None)
+
+# --- [파일 업로드: 청크 분할 + 이어받기] ---
+# init -> PUT /upload/<id>?offset=N (여러 번) -> finalize 순서로 진행합니다.
+# 청크는 요청 스트림에서 곧바로 임시 파일(.part)로 기록되므로 메모리 사용량은 CHUNK_BUF로 고정되고,
+# 진행 상태가 디스크에 남아 있어 연결이 끊기거나 서버가 재시작돼도 이어서 올릴 수 있습니다.
+PARTIAL_FOLDER = os.path.join(UPLOAD_FOLDER, '.partial')
+CHUNK_BUF = 64 * 1024
+MAX_UPLOAD_SIZE = 4 * 1024 ** 3
+PARTIAL_TTL = 24 * 3600
+if not os.path.exists(PARTIAL_FOLDER): os.makedirs(PARTIAL_FOLDER)
+chunk_locks = {}
+chunk_locks_guard = threading.Lock()
+upload_hashers = {}  # uid -> (sha256 진행 상태, 해시된 바이트 수)
+
+# 같은 내용은 uploads/blobs/ab/cd/<sha256> 하나로만 저장합니다. (중복 업로드는 디스크/쓰기 비용 0)
+# 해시 앞 2+2글자로 폴더를 나눠 한 폴더에 파일이 수만 개씩 몰리지 않게 합니다.
+BLOB_FOLDER = os.path.join(UPLOAD_FOLDER, 'blobs')
+if not os.path.exists(BLOB_FOLDER): os.makedirs(BLOB_FOLDER)
+blob_lock = threading.Lock()
+
+def blob_relpath(digest):
+    return f"{digest[:2]}/{digest[2:4]}/{digest}"
+
+def blob_path(digest):
+    return os.path.join(BLOB_FOLDER, digest[:2], digest[2:4], digest)
+
+def _hash_file(path):
+    """재시작 등으로 해시 진행 상태를 잃었을 때만 이미 받은 부분을 다시 읽습니다."""
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for buf in iter(lambda: f.read(CHUNK_BUF), b''): h.update(buf)
+    return h
+
+def _hasher_at(uid, part, pos):
+    h, hpos = upload_hashers.get(uid, (None, -1))
+    return h if hpos == pos else _hash_file(part)
+
+def _partial_paths(uid):
+    if not re.fullmatch(r'[0-9a-f]{32}', uid or ''): return None
+    base = os.path.join(PARTIAL_FOLDER, uid)
+    return base + '.part', base + '.json'
+
+def _load_partial(uid):
+    paths = _partial_paths(uid)
+    if not paths or not os.path.exists(paths[1]): return None, None
+    with open(paths[1], encoding='utf-8') as f: return paths, json.load(f)
+
+def _purge_stale_partials():
+    """오래 방치된 미완료 업로드를 치웁니다. (.partial 폴더만 확인, 메모리의 잠금/해시 상태도 함께)"""
+    cutoff = time.time() - PARTIAL_TTL
+    for name in os.listdir(PARTIAL_FOLDER):
+        path = os.path.join(PARTIAL_FOLDER, name)
+        try:
+            if os.path.getmtime(path) < cutoff: os.remove(path)
+            else: continue
+        except OSError: continue
+        uid = name.split('.', 1)[0]
+        with chunk_locks_guard: chunk_locks.pop(uid, None)
+        upload_hashers.pop(uid, None)
+        release_quota(uid)
+
+def store_blob(conn, tmp_path, digest):
+    """임시 파일을 blob으로 등록합니다. 이미 같은 내용이 있으면 임시 파일만 지우고 참조 수만 올립니다.
+    tmp_path 가 None 이면 이미 있는 blob 에 참조만 더합니다. (없으면 FileNotFoundError)"""
+    blob = blob_path(digest)
+    if tmp_path is None:
+        row = conn.execute("SELECT size FROM blobs WHERE hash = ?", (digest,)).fetchone()
+        if not row or not os.path.exists(blob): raise FileNotFoundError(digest)
+        size = row[0]
+    elif os.path.exists(blob):
+        size = os.path.getsize(tmp_path)
+        os.remove(tmp_path)
+    else:
+        size = os.path.getsize(tmp_path)
+        os.makedirs(os.path.dirname(blob), exist_ok=True)
+        os.replace(tmp_path, blob)  # 같은 디스크 안에서의 이름 변경이라 추가 복사가 없음
+    conn.execute("INSERT INTO blobs (hash, size, refs, last_access) VALUES (?, ?, 1, ?) ON CONFLICT(hash) DO UPDATE SET refs = refs + 1, last_access = excluded.last_access", (digest, size, time.time()))
+    return size
+
+def release_blob(conn, digest):
+    """참조 수를 내리고, 아무도 참조하지 않는 blob은 디스크에서 지웁니다."""
+    conn.execute("UPDATE blobs SET refs = refs - 1 WHERE hash = ?", (digest,))
+    if conn.execute("SELECT 1 FROM blobs WHERE hash = ? AND refs <= 0", (digest,)).fetchone():
+        conn.execute("DELETE FROM blobs WHERE hash = ?", (digest,))
+        try: os.remove(blob_path(digest))
+        except FileNotFoundError: pass
+
+def delete_upload(name):
+    """공유 파일 하나를 지웁니다. 같은 내용을 가리키는 다른 이름이 있으면 blob은 남습니다."""
+    with blob_lock, db_connect() as conn:
+        row = conn.execute("SELECT hash FROM uploads WHERE name = ?", (name,)).fetchone()
+        if not row: return False
+        conn.execute("DELETE FROM uploads WHERE name = ?", (name,))
+        release_blob(conn, row[0])
+        return True
+
+# --- [저장 용량 제한 + LRU 정리] ---
+# 전체/사용자별 용량 한도를 두고, 전체 사용량이 상한선(GC_HIGH_WATER)을 넘으면 가장 오래 다운로드되지 않은
+# blob부터 하한선(GC_LOW_WATER)까지 지웁니다. 사용량과 접근 시각은 모두 DB(blobs 색인)에서 읽으므로
+# 폴더를 훑을 필요가 없습니다. 다운로드 시각은 메모리에 모았다가 GC가 돌 때 한꺼번에 DB에 씁니다.
+STORAGE_QUOTA = int(os.environ.get('EMPIRE_STORAGE_QUOTA', 20 * 1024 ** 3))
+USER_QUOTA = int(os.environ.get('EMPIRE_USER_QUOTA', 2 * 1024 ** 3))
+GC_HIGH_WATER = 0.90
+GC_LOW_WATER = 0.75
+GC_INTERVAL = 60
+blob_access = {}
+blob_access_lock = threading.Lock()
+gc_wakeup = threading.Event()
+# 처리 중인 업로드 작업이 가리키는 blob (GC 가 지우지 않음) 과, init 은 했지만 아직 색인에 없는 업로드의 예약 용량
+pinned_blobs = collections.Counter()
+upload_reservations = {}  # uid -> (닉네임, 크기)
+quota_lock = threading.Lock()
+
+def pin_blob(digest, n=1):
+    with quota_lock:
+        pinned_blobs[digest] += n
+        if pinned_blobs[digest] <= 0: del pinned_blobs[digest]
+
+def reserve_quota(nick, uid, size):
+    """사용량 + 진행 중인 업로드 예약분 + size 가 한도 안이면 예약하고 True. (동시에 온 init 들이 함께 한도를 넘지 않게)"""
+    with quota_lock:
+        reserved = sum(n for owner, n in upload_reservations.values() if owner == nick)
+        if user_storage(nick) + reserved + size > USER_QUOTA: return False
+        upload_reservations[uid] = (nick, size)
+        return True
+
+def release_quota(uid):
+    with quota_lock: upload_reservations.pop(uid, None)
+
+def touch_blob(digest):
+    with blob_access_lock: blob_access[digest] = time.time()
+
+def user_storage(nick):
+    with db_connect() as conn:
+        return conn.execute("SELECT COALESCE(SUM(size), 0) FROM uploads WHERE owner = ?", (nick,)).fetchone()[0]
+
+def flush_blob_access(conn):
+    global blob_access
+    with blob_access_lock: pending, blob_access = blob_access, {}
+    conn.executemany("UPDATE blobs SET last_access = ? WHERE hash = ? AND last_access < ?",
+                     [(t, h, t) for h, t in pending.items()])
+
+def storage_gc():
+    """상한선을 넘었으면 LRU 순으로 blob(과 그것을 가리키는 공유 이름)을 지우고, 확보한 바이트 수를 돌려줍니다."""
+    victims = []
+    with blob_lock:
+        with db_connect() as conn:
+            flush_blob_access(conn)
+            used = conn.execute("SELECT COALESCE(SUM(size), 0) FROM blobs").fetchone()[0]
+            if used < STORAGE_QUOTA * GC_HIGH_WATER: return 0
+            target = STORAGE_QUOTA * GC_LOW_WATER
+            with quota_lock: busy = list(pinned_blobs)  # 처리 중인 작업의 blob 은 건너뜀 (blob_lock 안이라 새 등록도 끼어들지 못함)
+            while used > target:
+                batch = conn.execute(f"SELECT hash, size FROM blobs WHERE hash NOT IN ({','.join('?' * len(busy))}) ORDER BY last_access LIMIT 256", busy).fetchall()
+                if not batch: break
+                for digest, size in batch:
+                    if used <= target: break
+                    conn.execute("DELETE FROM uploads WHERE hash = ?", (digest,))
+                    conn.execute("DELETE FROM blobs WHERE hash = ?", (digest,))
+                    victims.append(digest); used -= size
+        # DB 커밋이 끝난 뒤에 파일을 지워야 색인에 없는 파일은 생겨도 파일 없는 색인은 생기지 않음
+        freed = 0
+        for digest in victims:
+            try:
+                path = blob_path(digest); freed += os.path.getsize(path); os.remove(path)
+            except FileNotFoundError: pass
+    return freed
+
+def storage_gc_loop():
+    while True:
+        gc_wakeup.wait(GC_INTERVAL); gc_wakeup.clear()
+        try:
+            freed = storage_gc()
+            if freed: print(f"Storage GC: {freed:,} bytes freed")
+        except Exception as e:
+            print(f"Storage GC Error: {e}")
+
+def register_upload(nick, orig_name, tmp_path, digest, encoding=None, mime=None):
+    """임시 파일을 blob 저장소와 uploads 색인에 등록하고 공개 이름을 돌려줍니다.
+    공개 이름은 색인의 id를 앞에 붙이므로 같은 초에 같은 이름이 와도 겹치지 않습니다."""
+    base = secure_filename(orig_name) or 'file'
+    mime = mime or mimetypes.guess_type(base)[0] or 'application/octet-stream'
+    with blob_lock, db_connect() as conn:
+        size = store_blob(conn, tmp_path, digest)
+        cur = conn.execute("INSERT INTO uploads (owner, orig_name, size, mime, hash, encoding) VALUES (?, ?, ?, ?, ?, ?)", (nick, orig_name, size, mime, digest, encoding))
+        fname = f"{cur.lastrowid}_{base}"
+        conn.execute("UPDATE uploads SET name = ? WHERE id = ?", (fname, cur.lastrowid))
+    gc_wakeup.set()
+    return fname, size
+
+PREVIEW_CHARS = 200
+PREVIEW_LINES = 4
+
+def save_text_upload(nick, text, orig_name):
+    """긴 메시지 등 서버가 만든 텍스트를 gzip으로 압축해 같은 blob 저장소/색인에 넣습니다.
+    (mtime=0 으로 압축 결과를 고정해야 같은 내용이 같은 해시로 중복 제거됩니다)"""
+    data = gzip.compress(text.encode('utf-8'), compresslevel=6, mtime=0)
+    tmp = os.path.join(PARTIAL_FOLDER, uuid.uuid4().hex + '.part')
+    with open(tmp, 'wb') as f: f.write(data)
+    return register_upload(nick, orig_name, tmp, hashlib.sha256(data).hexdigest(), encoding='gzip')[0]
+
+def text_preview(text):
+    """다운로드 없이 채팅창에서 볼 수 있는 짧은 미리보기"""
+    lines = text[:PREVIEW_CHARS].splitlines()[:PREVIEW_LINES]
+    preview = "\n".join(lines)
+    return preview + ("…" if len(preview) < len(text) else "")
+
+# --- [업로드 후처리 파이프라인] ---
+# HTTP 요청은 바이트가 디스크에 fsync되고 작업이 .partial/<id>.json 에 기록되는 순간 응답합니다.
+# 형식 판별, 미리보기, blob 등록, 보상, 공유 방송은 작업 큐의 워커 스레드가 정해진 순서대로 처리하며,
+# 단계가 하나 끝날 때마다 작업 기록(done = 끝난 단계 수)을 갱신하고 모든 단계가 끝난 뒤에야 지우므로,
+# 서버가 도중에 죽거나 단계가 실패해도 재시작 시 다음 단계부터 이어서 처리됩니다. (죽은 순간의 단계만 한 번 더 실행될 수 있음)
+UPLOAD_WORKERS = 2
+upload_jobs = queue.Queue()
+MAGIC_TYPES = [
+    (b'\x89PNG\r\n\x1a\n', 'image/png'), (b'\xff\xd8\xff', 'image/jpeg'), (b'GIF8', 'image/gif'),
+    (b'%PDF-', 'application/pdf'), (b'PK\x03\x04', 'application/zip'), (b'\x1f\x8b', 'application/gzip'),
+    (b'MZ', 'application/vnd.microsoft.portable-executable'), (b'\x7fELF', 'application/x-executable'),
+]
+
+def _fsync_file(path):
+    with open(path, 'rb+') as f: os.fsync(f.fileno())
+
+def _write_job(uid, meta):
+    """작업 기록을 원자적으로 교체합니다."""
+    meta_path = _partial_paths(uid)[1]
+    with open(meta_path + '.tmp', 'w', encoding='utf-8') as f:
+        json.dump(meta, f, ensure_ascii=False); f.flush(); os.fsync(f.fileno())
+    os.replace(meta_path + '.tmp', meta_path)
+
+def enqueue_upload(uid, meta):
+    """다 받은 업로드를 작업으로 기록하고 큐에 넣습니다. 작업이 끝날 때까지 그 blob 은 GC 대상에서 빠집니다."""
+    _write_job(uid, meta)
+    pin_blob(meta['digest'])
+    upload_jobs.put(uid)
+
+def sniff_mime(path, orig_name):
+    with open(path, 'rb') as f: head = f.read(2048)
+    for magic, mime in MAGIC_TYPES:
+        if head.startswith(magic): return mime
+    guessed = mimetypes.guess_type(orig_name)[0]
+    if guessed: return guessed
+    for cut in range(4):  # 읽은 범위 끝에서 잘린 멀티바이트 글자는 봐줌
+        try:
+            head[:len(head) - cut].decode('utf-8')
+            return 'text/plain'
+        except UnicodeDecodeError: pass
+    return 'application/octet-stream'
+
+def stage_sniff(job):
+    job['mime'] = sniff_mime(job['tmp'], job['filename'])
+
+def stage_preview(job):
+    job['preview'] = None
+    if job['mime'].startswith('text/'):
+        with open(job['tmp'], 'rb') as f: head = f.read(PREVIEW_CHARS * 4)
+        job['preview'] = text_preview(head.decode('utf-8', errors='ignore')) or None
+
+def stage_register(job):
+    if job.get('linked'): return  # 해시 일치로 init 때 이미 기존 blob 에 이름만 붙임
+    # 등록 직후 done 을 남기기 전에 죽었다면 .part 는 이미 blob 으로 옮겨졌으므로 그 blob 에 이름을 붙임
+    tmp = job['tmp'] if os.path.exists(job['tmp']) else None
+    job['fname'], job['size'] = register_upload(job['nickname'], job['filename'], tmp, job['digest'], mime=job['mime'])
+    release_quota(job['uid'])  # 이제 uploads 색인의 사용량에 들어감
+
+def stage_reward(job):
+    # 기존 blob 에 이름만 붙인 업로드는 보상 없음 (공개된 파일을 받아 해시만 맞춰 보상을 반복해 받지 못하게)
+    job['reward'] = 0 if job.get('linked') else 10000 + (job['size'] // 5)
+    if job['reward']: update_db(job['nickname'], "money", job['reward'], 'upload')
+
+def stage_announce(job):
+    nick, reward = job['nickname'], job['reward']
+    if reward >= 50000:
+        broadcast_news(f"{nick}님이 귀중한 파일을 공유하여 {reward:,}₩의 거액을 하사받았습니다!")
+    f_url = f"{job['host_url'].rstrip('/')}/uploads/{job['fname']}"
+    msg = f"📁 [파일 공유] {job['filename']}\n"
+    if job['preview']: msg += f"{job['preview']}\n"
+    msg += f"🔗 다운로드: {f_url}"
+    socketio.emit('message', {'nickname': nick, 'msg': msg, 'type': 'chat', 'rank': '시스템', 'reward': f"+{reward:,}₩"}, room='main')
+
+UPLOAD_STAGES = [stage_sniff, stage_preview, stage_register, stage_reward, stage_announce]
+
+def process_upload(uid):
+    paths, meta = _load_partial(uid)
+    if not meta: return
+    job = dict(meta, uid=uid, tmp=blob_path(meta['digest']) if meta.get('linked') else paths[0])
+    done = meta.get('done', 0)
+    for i, stage in enumerate(UPLOAD_STAGES[done:], done + 1):
+        stage(job)
+        job['done'] = i
+        if i < len(UPLOAD_STAGES): _write_job(uid, {k: v for k, v in job.items() if k not in ('tmp', 'uid')})
+    os.remove(paths[1])
+    pin_blob(meta['digest'], -1)
+
+def upload_worker():
+    while True:
+        uid = upload_jobs.get()
+        try: process_upload(uid)
+        except Exception as e: print(f"Upload Job Error: {e}")
+        finally: upload_jobs.task_done()
+
+def recover_upload_jobs():
+    """재시작 전에 접수만 되고 처리되지 못한 작업을 다시 큐에 넣고, 아직 색인에 없는 업로드의 용량 예약을 되살립니다."""
+    for name in os.listdir(PARTIAL_FOLDER):
+        if not name.endswith('.json'): continue
+        paths, meta = _load_partial(name[:-5])
+        if not meta: continue
+        if not meta.get('fname'): upload_reservations[name[:-5]] = (meta['nickname'], meta.get('size', 0))
+        if meta.get('digest'):
+            pin_blob(meta['digest'])
+            upload_jobs.put(name[:-5])
 
 @app.route('/upload', methods=['POST'])
 def upload():
+    """기존 한 번에 올리는 multipart 방식 (구버전 클라이언트 호환용)"""
     file = request.files.get('file'); nick = request.form.get('nickname', '익명')
     if file:
-        fname = f"{int(time.time())}_{secure_filename(file.filename)}"
-        path = os.path.join(app.config['UPLOAD_FOLDER'], fname)
-        file.save(path)
-        reward = 10000 + (os.path.getsize(path) // 5)
-        update_db(nick, "money", reward)
-        if reward >= 50000:
-            broadcast_news(f"{nick}님이 귀중한 파일을 공유하여 {reward:,}₩의 거액을 하사받았습니다!")
-        f_url = f"{request.host_url.rstrip('/')}/uploads/{fname}"
-        msg = f"📁 [파일 공유] {file.filename}\n🔗 다운로드: {f_url}"
-        socketio.emit('message', {'nickname': nick, 'msg': msg, 'type': 'chat', 'rank': '시스템', 'reward': f"+{reward:,}₩"}, room='main')
+        uid = uuid.uuid4().hex
+        if not reserve_quota(nick, uid, request.content_length or 0):
+            return jsonify(error='quota exceeded'), 413
+        h = hashlib.sha256()
+        with open(_partial_paths(uid)[0], 'wb') as f:
+            for buf in iter(lambda: file.stream.read(CHUNK_BUF), b''):
+                h.update(buf); f.write(buf)
+                inc('empire_upload_bytes_total', len(buf))
+            f.flush(); os.fsync(f.fileno())
+        enqueue_upload(uid, {'nickname': nick, 'filename': file.filename, 'digest': h.hexdigest(), 'host_url': request.host_url})
     return '', 204
 
+# 중복 업로드 건너뛰기: init 에 sha256 을 보냈고 같은 크기의 blob 이 있으면 서버가 임의 구간(PROOF_BYTES 이하)을 골라
+# 돌려주고, 클라이언트가 그 구간의 해시를 /upload/<id>/link 로 보내 실제로 내용을 가졌음을 보이면 이름만 붙입니다.
+# 해시는 ETag 등으로 공개되어 있으므로 해시만으로는 연결하지 않고, 연결된 업로드에는 보상을 주지 않습니다.
+PROOF_BYTES = 64 * 1024
+
+def blob_size(digest):
+    with db_connect() as conn:
+        row = conn.execute("SELECT size FROM blobs WHERE hash = ?", (digest,)).fetchone()
+    return row[0] if row else None
+
+def link_existing_blob(uid, nick, name, size, digest):
+    """바이트를 받지 않고 기존 blob 에 새 이름만 붙인 뒤 나머지 단계를 작업으로 넘깁니다."""
+    if blob_size(digest) != size: return False
+    pin_blob(digest)  # 등록 전에 GC 에서 빼 둠 (작업이 큐에 들어가면 작업의 pin 이 이어받음)
+    try:
+        mime = sniff_mime(blob_path(digest), name) if os.path.exists(blob_path(digest)) else None
+        try: fname, size = register_upload(nick, name, None, digest, mime=mime)
+        except FileNotFoundError: return False  # 그 사이 GC 로 지워짐: 평소처럼 받음
+        release_quota(uid)
+        enqueue_upload(uid, {'nickname': nick, 'filename': name, 'size': size, 'digest': digest, 'host_url': request.host_url,
+                             'fname': fname, 'linked': True})
+        return True
+    finally:
+        pin_blob(digest, -1)
+
+@app.route('/upload/init', methods=['POST'])
+def upload_init():
+    d = request.get_json(silent=True) or {}
+    nick, name = d.get('nickname', '익명'), d.get('filename', '')
+    try: size = int(d.get('size', -1))
+    except (TypeError, ValueError): size = -1
+    if not secure_filename(name) or not 0 <= size <= MAX_UPLOAD_SIZE:
+        return jsonify(error='bad upload'), 400
+    _purge_stale_partials()
+    uid = uuid.uuid4().hex
+    if not reserve_quota(nick, uid, size):
+        return jsonify(error='quota exceeded', used=user_storage(nick), quota=USER_QUOTA), 413
+    info, resp = {'nickname': nick, 'filename': name, 'size': size}, {'upload_id': uid, 'offset': 0, 'chunk_size': CHUNK_BUF * 16}
+    digest = d.get('sha256')
+    if isinstance(digest, str) and re.fullmatch(r'[0-9a-f]{64}', digest) and blob_size(digest) == size:
+        length = min(size, PROOF_BYTES)
+        offset = secrets.randbelow(size - length + 1)
+        info.update(claim=digest, challenge=[offset, length])
+        resp['challenge'] = {'offset': offset, 'length': length}
+    part, meta = _partial_paths(uid)
+    open(part, 'wb').close()
+    with open(meta, 'w', encoding='utf-8') as f:
+        json.dump(info, f, ensure_ascii=False)
+    return jsonify(resp)
+
+@app.route('/upload/<uid>/link', methods=['POST'])
+def upload_link(uid):
+    """init 이 고른 구간의 sha256(proof) 이 맞으면 전송 없이 기존 blob 에 연결합니다. 틀리면 평소처럼 청크로 올리면 됨 (기회는 한 번)"""
+    paths, meta = _load_partial(uid)
+    if not meta: return jsonify(error='unknown upload'), 404
+    if not meta.get('challenge') or meta.get('digest'): return jsonify(error='no challenge'), 409
+    (offset, length), claim = meta.pop('challenge'), meta.pop('claim')
+    with open(paths[1], 'w', encoding='utf-8') as f: json.dump(meta, f, ensure_ascii=False)
+    proof = (request.get_json(silent=True) or {}).get('proof')
+    try:
+        with open(blob_path(claim), 'rb') as f:
+            f.seek(offset); expect = hashlib.sha256(f.read(length)).hexdigest()
+    except FileNotFoundError: expect = None
+    if not (expect and isinstance(proof, str) and hmac.compare_digest(proof, expect)):
+        return jsonify(error='proof mismatch', offset=0), 403
+    if not link_existing_blob(uid, meta['nickname'], meta['filename'], meta['size'], claim):
+        return jsonify(error='blob gone', offset=0), 409
+    os.remove(paths[0])
+    return jsonify(upload_id=uid, offset=meta['size'], status='processing', deduplicated=True), 202
+
+@app.route('/upload/<uid>', methods=['GET'])
+def upload_status(uid):
+    """이어받기: 서버가 지금까지 받은 바이트 수를 알려줍니다."""
+    paths, meta = _load_partial(uid)
+    if not meta: return jsonify(error='unknown upload'), 404
+    if meta.get('digest'):  # 이미 finalize 됨 (.part 는 처리 중에 blob 으로 옮겨질 수 있음)
+        return jsonify(upload_id=uid, offset=meta['size'], size=meta['size'], status='processing')
+    return jsonify(upload_id=uid, offset=os.path.getsize(paths[0]), size=meta['size'])
+
+@app.route('/upload/<uid>', methods=['PUT'])
+def upload_chunk(uid):
+    paths, meta = _load_partial(uid)
+    if not meta: return jsonify(error='unknown upload'), 404
+    if meta.get('digest'): return jsonify(error='already finalized'), 409
+    with chunk_locks_guard: lock = chunk_locks.setdefault(uid, threading.Lock())
+    if not lock.acquire(blocking=False):
+        return jsonify(error='chunk in progress'), 409
+    try:
+        cur = os.path.getsize(paths[0])
+        if request.args.get('offset', type=int) != cur:
+            return jsonify(offset=cur), 409  # 클라이언트는 이 offset부터 다시 보냄
+        h = _hasher_at(uid, paths[0], cur)
+        try:
+            with open(paths[0], 'r+b') as f:
+                f.seek(cur)
+                while True:
+                    buf = request.stream.read(CHUNK_BUF)
+                    if not buf: break
+                    if cur + len(buf) > meta['size']:
+                        return jsonify(error='too large', offset=cur), 413
+                    f.write(buf); h.update(buf); cur += len(buf)
+                    inc('empire_upload_bytes_total', len(buf))
+        finally:
+            upload_hashers[uid] = (h, cur)  # 끊긴 청크도 쓴 만큼은 해시에 반영돼 있음
+        return jsonify(offset=cur)
+    finally:
+        lock.release()
+
+@app.route('/upload/<uid>/finalize', methods=['POST'])
+def upload_finalize(uid):
+    paths, meta = _load_partial(uid)
+    if not meta: return jsonify(error='unknown upload'), 404
+    with chunk_locks_guard: lock = chunk_locks.setdefault(uid, threading.Lock())
+    with lock:
+        paths, meta = _load_partial(uid)
+        if not meta: return jsonify(error='unknown upload'), 404
+        if not meta.get('digest'):  # 두 번째 finalize는 이미 접수된 작업을 그대로 둠
+            got = os.path.getsize(paths[0])
+            if got != meta['size']:
+                return jsonify(error='incomplete', offset=got), 409
+            _fsync_file(paths[0])
+            meta.update(digest=_hasher_at(uid, paths[0], got).hexdigest(), host_url=request.host_url)
+            enqueue_upload(uid, meta)
+    with chunk_locks_guard: chunk_locks.pop(uid, None)
+    upload_hashers.pop(uid, None)
+    return jsonify(upload_id=uid, status='processing'), 202
+
+recover_upload_jobs()
+for _ in range(UPLOAD_WORKERS):
+    threading.Thread(target=upload_worker, daemon=True).start()
+threading.Thread(target=storage_gc_loop, daemon=True).start()
+
+# --- [관리자 전용 API] ---
+# EMPIRE_ADMIN_TOKEN 환경변수를 설정해야 켜지며, 요청 헤더 X-Admin-Token (또는 ?token=) 으로 확인합니다.
+ADMIN_TOKEN = os.environ.get('EMPIRE_ADMIN_TOKEN')
+
+def is_admin():
+    given = request.headers.get('X-Admin-Token') or request.args.get('token') or ''
+    return bool(ADMIN_TOKEN) and hmac.compare_digest(given, ADMIN_TOKEN)
+
+def admin_only(fn):
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        if not is_admin(): return jsonify(error='forbidden'), 403
+        return fn(*args, **kwargs)
+    return wrapper
+
+# --- [온디맨드 프로파일링] ---
+# 관리자가 켜면 정해진 시간(seconds) 또는 이벤트 수(events)만큼만 프로파일링하고 profiles/ 에 결과를 남깁니다.
+#  - sample  : 별도 스레드가 sys._current_frames() 로 모든 스레드(소켓 핸들러, 라우트, 배경 스레드)의 스택을
+#              주기적으로 찍어 flamegraph 용 collapsed stack(.collapsed) 파일로 저장
+#  - cprofile: 소켓 핸들러/Flask 요청 하나하나를 cProfile 로 감싸 합친 pstats(.pstats) 파일로 저장
+# 꺼져 있을 때는 샘플러 스레드가 없고, 핸들러에서는 profiler['active'] 확인 한 번이 전부입니다.
+PROFILE_FOLDER = 'profiles'
+PROFILE_MAX_SECONDS = 600
+profiler = {'active': False, 'mode': None, 'until': 0, 'events_left': None, 'samples': None, 'stats': None, 'last_dump': None,
+            'timer': None}
+profiler_lock = threading.Lock()
+
+def start_profile(mode='sample', seconds=30, events=None, interval=0.005):
+    with profiler_lock:
+        if profiler['active']: return False
+        profiler.update(active=True, mode=mode, until=time.time() + min(seconds, PROFILE_MAX_SECONDS), events_left=events,
+                        samples=collections.Counter(), stats=None)
+    if mode == 'sample':
+        threading.Thread(target=_sampler_loop, args=(interval,), daemon=True).start()
+    else:
+        timer = profiler['timer'] = threading.Timer(min(seconds, PROFILE_MAX_SECONDS), stop_profile)
+        timer.daemon = True  # 프로파일 중이어도 서버 종료를 막지 않음
+        timer.start()
+    return True
+
+def stop_profile():
+    """프로파일링을 끝내고 결과 파일 경로를 돌려줍니다."""
+    with profiler_lock:
+        if not profiler['active']: return None
+        profiler['active'] = False
+        if profiler['timer']: profiler['timer'].cancel()  # 일찍 끝났으면 남은 타이머가 다음 세션을 끊지 않게
+        profiler['timer'] = None
+        os.makedirs(PROFILE_FOLDER, exist_ok=True)
+        stamp = time.strftime('%Y%m%d_%H%M%S')
+        if profiler['mode'] == 'sample':
+            path = os.path.join(PROFILE_FOLDER, f"profile_{stamp}.collapsed")
+            with open(path, 'w', encoding='utf-8') as f:
+                for stack, n in profiler['samples'].most_common(): f.write(f"{stack} {n}\n")
+        else:
+            path = os.path.join(PROFILE_FOLDER, f"profile_{stamp}.pstats")
+            if profiler['stats']: profiler['stats'].dump_stats(path)
+            else: open(path, 'wb').close()
+        profiler['last_dump'] = path
+        return path
+
+def _count_profile_event():
+    with profiler_lock:
+        if profiler['events_left'] is None: return
+        profiler['events_left'] -= 1
+        done = profiler['events_left'] <= 0
+    if done: stop_profile()
+
+def _sampler_loop(interval):
+    me = threading.get_ident()
+    while profiler['active'] and time.time() < profiler['until']:
+        names = {t.ident: t.name for t in threading.enumerate()}
+        for tid, frame in sys._current_frames().items():
+            if tid == me: continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                frame = frame.f_back
+            stack.append(names.get(tid, str(tid)))
+            profiler['samples'][";".join(reversed(stack))] += 1
+        time.sleep(interval)
+    stop_profile()
+
+def _merge_profile(pr):
+    with profiler_lock:
+        if profiler['stats'] is None: profiler['stats'] = pstats.Stats(pr)
+        else: profiler['stats'].add(pr)
+
+def profile_hook(fn):
+    """소켓 핸들러용: 프로파일링 중일 때만 cProfile 로 감싸고 이벤트 수를 셉니다."""
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        if not profiler['active']: return fn(*args, **kwargs)
+        pr = cProfile.Profile() if profiler['mode'] == 'cprofile' else None
+        if pr: pr.enable()
+        try: return fn(*args, **kwargs)
+        finally:
+            if pr:
+                pr.disable(); _merge_profile(pr)
+            _count_profile_event()
+    return wrapper
+
+@app.before_request
+def _profile_request_start():
+    if profiler['active'] and profiler['mode'] == 'cprofile':
+        g.profile = cProfile.Profile(); g.profile.enable()
+
+@app.teardown_request
+def _profile_request_end(exc=None):
+    pr = g.pop('profile', None)
+    if pr:
+        pr.disable(); _merge_profile(pr)
+    # 소켓 이벤트도 요청 컨텍스트를 열고 닫지만(endpoint 없음) 그쪽은 profile_hook 에서 셉니다.
+    if profiler['active'] and request.endpoint not in (None, 'admin_profile'): _count_profile_event()
+
+@app.route('/admin/profile', methods=['GET', 'POST', 'DELETE'])
+@admin_only
+def admin_profile():
+    """POST {mode, seconds, events, interval_ms} 시작 / DELETE 즉시 종료 / GET 상태와 결과 파일 목록"""
+    if request.method == 'POST':
+        d = request.get_json(silent=True) or {}
+        mode = d.get('mode', 'sample')
+        if mode not in ('sample', 'cprofile'): return jsonify(error='mode must be sample or cprofile'), 400
+        try:
+            seconds, interval_ms = float(d.get('seconds', 30)), float(d.get('interval_ms', 5))
+            events = int(d['events']) if d.get('events') else None
+        except (TypeError, ValueError):
+            return jsonify(error='seconds, interval_ms and events must be numbers'), 400
+        if not (math.isfinite(seconds) and seconds > 0 and math.isfinite(interval_ms)) or (events is not None and events <= 0):
+            return jsonify(error='seconds must be > 0, interval_ms finite, events > 0'), 400
+        if not start_profile(mode, seconds, events, max(interval_ms, 1.0) / 1000):
+            return jsonify(error='already running'), 409
+    elif request.method == 'DELETE':
+        return jsonify(dump=stop_profile())
+    files = sorted(os.listdir(PROFILE_FOLDER)) if os.path.isdir(PROFILE_FOLDER) else []
+    return jsonify(active=profiler['active'], mode=profiler['mode'], events_left=profiler['events_left'],
+                   last_dump=profiler['last_dump'], files=files)
+
+@app.route('/admin/profile/<name>')
+@admin_only
+def admin_profile_file(name):
+    return send_from_directory(os.path.abspath(PROFILE_FOLDER), secure_filename(name), as_attachment=True)
+
+@app.route('/admin/traces')
+@admin_only
+def admin_traces():
+    """링 버퍼에서 가장 느린 trace N개 (?n=20&command=chat|!랭킹|...)"""
+    n = max(1, min(request.args.get('n', 20, type=int), 200))
+    cmd = request.args.get('command')
+    traces = [t for t in list(TRACE_RING) if not cmd or t['attrs'].get('command') == cmd]
+    return jsonify(buffered=len(traces), capacity=TRACE_RING.maxlen, traces=heapq.nlargest(n, traces, key=lambda t: t['ms']))
+
+@app.route('/admin/sql', methods=['GET', 'DELETE'])
+@admin_only
+def admin_sql():
+    """문장 틀별 통계 (?sort=total|max|count|slow&n=50) 와 최근 느린 쿼리. DELETE 는 초기화"""
+    if request.method == 'DELETE':
+        with sql_stats_lock: sql_stats.clear()
+        SLOW_QUERIES.clear()
+        return jsonify(ok=True)
+    col = {'count': 0, 'total': 1, 'max': 2, 'slow': 3}.get(request.args.get('sort', 'total'), 1)
+    n = max(1, min(request.args.get('n', 50, type=int), 500))
+    with sql_stats_lock: rows = [(tpl, list(st)) for tpl, st in sql_stats.items()]
+    rows.sort(key=lambda r: r[1][col], reverse=True)
+    stats = [{'template': tpl, 'count': c, 'total_ms': round(t * 1000, 3), 'avg_ms': round(t * 1000 / c, 3),
+              'max_ms': round(mx * 1000, 3), 'slow': sl} for tpl, (c, t, mx, sl) in rows[:n]]
+    return jsonify(threshold_ms=SLOW_QUERY_MS, templates=len(rows), stats=stats, slow=list(SLOW_QUERIES)[::-1])
+
+@app.route('/metrics')
+def metrics():
+    return app.response_class(render_metrics(), mimetype='text/plain; version=0.0.4')
+
+@socketio.on('connect')
+def on_connect(auth=None):
+    global connected_clients
+    with _metric_shards_lock: connected_clients += 1
+    inc('empire_connected_clients', 1)
+
+@socketio.on('disconnect')
+def on_disconnect(*args):
+    global connected_clients
+    with _metric_shards_lock: connected_clients -= 1
+    inc('empire_connected_clients', -1)
+    wealth_offline(request.sid)
+
 @socketio.on('join')
+@profile_hook
 def on_join(d):
-    join_room('main')
-    with sqlite3.connect(DB_FILE) as conn:
+    last_id = d.get('last_id')
+    with history_lock:  # 재생 emit 까지 잠금 안에서 (그 사이 새 방송이 재생분보다 먼저 나가지 않게)
+        join_room('main')
+        recent = list(message_history)
+        first_id = recent[0]['id'] if recent else 1
+        if d.get('epoch') == SERVER_EPOCH and isinstance(last_id, int) and last_id >= first_id - 1:
+            mode, items = 'delta', recent[last_id - first_id + 1:]  # id 가 연속이므로 바로 잘라냄
+        else:
+            mode, items = 'snapshot', recent[-SNAPSHOT_SIZE:]
+        emit('resume', {'epoch': SERVER_EPOCH, 'mode': mode, 'count': len(items)})
+        for m in items: emit('message', m)
+    for asset in ASSETS: emit('book_snapshot', book_depth(asset))
+    if d.get('nickname'):
+        total = wealth_online(request.sid, d['nickname'])
+        emit('wealth', {'total_asset': total, 'rank': rank_of(total)})
+
+# --- [온라인 백업 / JSONL 내보내기·가져오기] ---
+# 서버가 쓰는 중에도 SQLite 백업 API 로 BACKUP_PAGES 페이지씩 나눠 복사하고 단계 사이에 쉬므로
+# 채팅 쓰기가 오래 막히지 않습니다. 다른 연결이 쓰면 백업이 처음부터 다시 시작되므로, 쓰기가 끊이지 않아
+# BACKUP_DEADLINE 안에 못 끝내면 남은 것을 한 번에 복사합니다(그동안만 쓰기가 잠시 대기). 복사본은 검사(quick_check) 후 이름을 바꿔 backups/ 에 최근 BACKUP_KEEP 개만 둡니다.
+# JSONL 내보내기도 라이브 DB 대신 방금 뜬 백업본을 읽으므로 느린 다운로드가 쓰기 잠금을 붙잡지 않습니다.
+BACKUP_FOLDER = 'backups'
+BACKUP_EVERY = int(os.environ.get('EMPIRE_BACKUP_EVERY', 3600))  # 초, 0 이면 자동 백업 끔
+BACKUP_KEEP = int(os.environ.get('EMPIRE_BACKUP_KEEP', 24))
+BACKUP_PAGES = 256
+BACKUP_SLEEP = 0.01
+BACKUP_DEADLINE = 10.0
+EXPORT_TABLES = ('users', 'chats')
+IMPORT_BATCH = 500
+backup_lock = threading.Lock()
+
+def backup_db(dest=None):
+    """라이브 DB 를 dest(기본: backups/empire-날짜.sqlite)로 온라인 백업하고 경로를 돌려줍니다."""
+    os.makedirs(BACKUP_FOLDER, exist_ok=True)
+    dest = dest or os.path.join(BACKUP_FOLDER, time.strftime('empire-%Y%m%d-%H%M%S.sqlite'))
+    tmp = dest + '.tmp'
+    t0 = time.perf_counter()
+    with backup_lock:
+        src, dst = db_connect(), sqlite3.connect(tmp)
+        def progress(status, remaining, total):
+            if time.perf_counter() - t0 > BACKUP_DEADLINE: raise TimeoutError
+        try:
+            try: src.backup(dst, pages=BACKUP_PAGES, sleep=BACKUP_SLEEP, progress=progress)
+            except TimeoutError: src.backup(dst)
+            ok = dst.execute("PRAGMA quick_check").fetchone()[0]
+        finally:
+            dst.close(); src.close()
+        if ok != 'ok':
+            os.remove(tmp)
+            raise sqlite3.DatabaseError(f"backup check failed: {ok}")
+        os.replace(tmp, dest)
+    print(f"Backup: {dest} ({os.path.getsize(dest):,} bytes, {time.perf_counter() - t0:.2f}s)")
+    return dest
+
+def list_backups():
+    return sorted(n for n in os.listdir(BACKUP_FOLDER) if n.startswith('empire-') and n.endswith('.sqlite')) if os.path.isdir(BACKUP_FOLDER) else []
+
+def prune_backups():
+    for name in list_backups()[:-BACKUP_KEEP or None]:
+        os.remove(os.path.join(BACKUP_FOLDER, name))
+
+def backup_loop():
+    while True:
+        time.sleep(BACKUP_EVERY)
+        try:
+            backup_db(); prune_backups()
+        except Exception as e:
+            print(f"Backup Error: {e}")
+
+if BACKUP_EVERY > 0: threading.Thread(target=backup_loop, daemon=True).start()
+
+def export_jsonl(tables=EXPORT_TABLES):
+    """{"table": 이름, "row": {...}} 한 줄씩 내보냅니다. 시작할 때 뜬 백업본에서 읽으므로 한 시점의 일관된 내용입니다."""
+    snap = backup_db(os.path.join(BACKUP_FOLDER, f".export-{uuid.uuid4().hex}.sqlite"))
+    try:
+        conn = sqlite3.connect(snap)
+        conn.row_factory = sqlite3.Row
+        try:
+            for table in tables:
+                cur = conn.execute(f"SELECT * FROM {table} ORDER BY rowid")
+                while True:
+                    rows = cur.fetchmany(1000)
+                    if not rows: break
+                    for r in rows: yield json.dumps({'table': table, 'row': dict(r)}, ensure_ascii=False) + "\n"
+        finally:
+            conn.close()
+    finally:
+        os.remove(snap)
+
+def import_jsonl(lines, mode='skip'):
+    """export_jsonl 형식의 줄들을 IMPORT_BATCH 개씩 끊어 넣습니다. mode: skip(기존 행 유지) / replace(덮어쓰기)
+    열 이름은 실제 테이블 열과 맞는 것만 씁니다. 표 이름별 들어간 줄 수를 돌려줍니다."""
+    verb = {'skip': "INSERT OR IGNORE", 'replace': "INSERT OR REPLACE"}[mode]
+    with db_connect() as conn:
+        columns = {t: [r[1] for r in conn.execute(f"PRAGMA table_info({t})")] for t in EXPORT_TABLES}
+    counts, batch = {}, {}
+
+    def flush(table):
+        rows = batch.pop(table, None)
+        if not rows: return
+        cols = [c for c in columns[table] if c in rows[0]]
+        with db_connect(timeout=10) as conn:
+            cur = conn.executemany(f"{verb} INTO {table} ({', '.join(cols)}) VALUES ({', '.join('?' * len(cols))})",
+                                   [tuple(r.get(c) for c in cols) for r in rows])
+            counts[table] = counts.get(table, 0) + max(cur.rowcount, 0)
+
+    for line in lines:
+        if isinstance(line, bytes): line = line.decode('utf-8')
+        if not line.strip(): continue
+        rec = json.loads(line)
+        table, row = rec.get('table'), rec.get('row')
+        if table not in columns or not isinstance(row, dict): raise ValueError(f"bad record: {line[:80]}")
+        rows = batch.setdefault(table, [])
+        if rows and rows[0].keys() != row.keys(): flush(table); rows = batch.setdefault(table, [])
+        rows.append(row)
+        if len(rows) >= IMPORT_BATCH: flush(table)
+    for table in list(batch): flush(table)
+    return counts
+
+@app.route('/admin/backup', methods=['GET', 'POST'])
+@admin_only
+def admin_backup():
+    """GET: 백업 목록 / POST: 지금 백업"""
+    if request.method == 'POST':
+        try: path = backup_db()
+        except (sqlite3.Error, OSError) as e: return jsonify(error=str(e)), 500
+        prune_backups()
+        return jsonify(backup=os.path.basename(path), size=os.path.getsize(path))
+    return jsonify(backups=list_backups(), every=BACKUP_EVERY, keep=BACKUP_KEEP)
+
+@app.route('/admin/export')
+@admin_only
+def admin_export():
+    tables = [t for t in request.args.get('tables', ','.join(EXPORT_TABLES)).split(',') if t in EXPORT_TABLES]
+    resp = app.response_class(export_jsonl(tables), mimetype='application/x-ndjson')
+    resp.headers['Content-Disposition'] = f"attachment; filename=empire-{time.strftime('%Y%m%d-%H%M%S')}.jsonl"
+    return resp
+
+@app.route('/admin/import', methods=['POST'])
+@admin_only
+def admin_import():
+    """요청 본문(JSONL)을 줄 단위로 읽어 가져옵니다. ?mode=skip|replace"""
+    mode = request.args.get('mode', 'skip')
+    if mode not in ('skip', 'replace'): return jsonify(error='bad mode'), 400
+    try: counts = import_jsonl(iter(request.stream.readline, b''), mode)
+    except (ValueError, sqlite3.Error) as e: return jsonify(error=str(e)), 400
+    if counts.get('users'):  # 원장 밖에서 바뀐 잔액을 새 기준으로
+        snapshot_balances(everyone=True); load_wealth()
+    return jsonify(imported=counts)
+
+@app.route('/admin/ledger')
+@admin_only
+def admin_ledger():
+    """원장 (최신순, id 커서) ?nickname=&before=<id>&limit=100 / ?nickname=&at=<유닉스 시각> 이면 그 시점 잔액 재구성"""
+    nick = request.args.get('nickname')
+    if 'at' in request.args:
+        if not nick: return jsonify(error='nickname required'), 400
+        bal = balance_at(nick, request.args.get('at', type=float))
+        return (jsonify(nickname=nick, **bal) if bal else (jsonify(error='before ledger'), 404))
+    limit = max(1, min(request.args.get('limit', 100, type=int), 1000))
+    before = request.args.get('before', type=int)
+    sql, args = "SELECT id, nickname, col, amount, reason, time FROM ledger WHERE 1=1", []
+    if before is not None: sql += " AND id < ?"; args.append(before)
+    if nick: sql += " AND nickname = ?"; args.append(nick)
+    sql += " ORDER BY id DESC LIMIT ?"; args.append(limit)
+    with db_connect() as conn:
+        conn.row_factory = sqlite3.Row
+        items = [dict(r) for r in conn.execute(sql, args).fetchall()]
+    return jsonify(items=items, next_before=items[-1]['id'] if len(items) == limit else None)
+
+@app.route('/admin/ledger/snapshot', methods=['POST'])
+@admin_only
+def admin_ledger_snapshot():
+    head, n = snapshot_balances(everyone=request.args.get('all') == '1')
+    return jsonify(ledger_id=head, users=n)
+
+# --- [명령어 등록부] ---
+# @command 로 명령어를 등록하면 handle_msg 는 dict 조회 한 번으로 핸들러를 찾습니다.
+# args 는 (이름, 변환 타입, 기본값) 목록이며 REQUIRED 는 필수 인자, REST 타입은 남은 단어 전체입니다.
+# 금액/수량/번호처럼 양수여야 하는 인자는 pos_int 로 받아 음수·0·SQLite 범위 밖 값을 파싱 단계에서 거릅니다.
+# 명령어는 채팅 보상/기록을 거치지 않고, 필요한 DB 작업만 핸들러 안에서 합니다.
+COMMANDS = {}
+REQUIRED = object()
+REST = object()
+
+def pos_int(token):
+    """1 이상, SQLite INTEGER 에 들어가는 정수만 (아니면 ValueError → 사용법 안내)"""
+    n = int(token)
+    if not 0 < n < 2 ** 63: raise ValueError(token)
+    return n
+
+def pos_float(token):
+    """0 보다 큰 유한 실수만 (inf/nan/음수는 ValueError)"""
+    x = float(token)
+    if not (math.isfinite(x) and x > 0): raise ValueError(token)
+    return x
+RATE_CLASSES = {'light': 0.0, 'normal': 0.5, 'heavy': 2.0, 'ai': 5.0}  # 같은 사람이 같은 등급을 다시 쓰기까지의 초
+command_last = {}
+command_last_lock = threading.Lock()
+
+def command(*names, args=(), rate='light', usage=None):
+    def deco(fn):
+        spec = {'name': names[0], 'fn': fn, 'args': args, 'rate': rate, 'usage': usage or names[0]}
+        for n in names: COMMANDS[n] = spec
+        return fn
+    return deco
+
+def parse_args(spec, tokens):
+    """인자 스키마대로 변환합니다. 빠졌거나 형식이 틀리면 None"""
+    values = []
+    for i, (_, typ, default) in enumerate(spec['args']):
+        if typ is REST:
+            values.append(" ".join(tokens[i:]) or (None if default is REQUIRED else default))
+        elif i < len(tokens):
+            try: values.append(typ(tokens[i]))
+            except ValueError: return None
+        elif default is REQUIRED: return None
+        else: values.append(default)
+        if values[-1] is None and default is REQUIRED: return None
+    return values
+
+def rate_limited(nick, rate):
+    """아직 쿨타임이면 남은 초, 아니면 0"""
+    gap, now = RATE_CLASSES[rate], time.monotonic()
+    if not gap: return 0
+    with command_last_lock:  # 동시에 온 같은 명령이 둘 다 확인을 통과하지 않게
+        last = command_last.get((nick, rate), 0)
+        if now - last < gap: return gap - (now - last)
+        command_last[(nick, rate)] = now
+    return 0
+
+def run_command(spec, nick, raw):
+    args = parse_args(spec, raw.split()[1:])
+    if args is None:
+        emit('message', {'msg': f"❓ 사용법: {spec['usage']}", 'type': 'system'})
+        return
+    wait = rate_limited(nick, spec['rate'])
+    if wait:
+        emit('message', {'msg': f"⏳ {spec['name']} 은(는) {wait:.1f}초 뒤에 다시 쓸 수 있습니다.", 'type': 'system'})
+        return
+    with span(f"command {spec['name']}"):
+        spec['fn'](nick, *args)
+
+def asset_values(u):
+    """(코인 평가액, 총자산)"""
+    btc_v = int(u['btc_amount'] * crypto_prices['비트코인'])
+    return btc_v, u['money'] + u['bank_money'] + btc_v
+
+@command("!잔액")
+def cmd_balance(nick):
+    u = get_user(nick)
+    btc_v, total = asset_values(u)
+    res = f"💰 {nick}님 자산\n💵 현금: {u['money']:,}₩\n🏦 은행: {u['bank_money']:,}₩\n🪙 코인: {btc_v:,}₩\n💳 총액: {total:,}₩"
+    emit('message', {'msg': res, 'type': 'system', 'total_asset': total})
+
+@command("!랭킹", rate='heavy')
+def cmd_ranking(nick):
+    total = asset_values(get_user(nick))[1]
+    with db_connect() as conn:
         conn.row_factory = sqlite3.Row
-        for h in reversed(conn.execute("SELECT * FROM chats ORDER BY id DESC LIMIT 100").fetchall()):
-            emit('message', {'nickname': h['nickname'], 'msg': h['msg'], 'type': h['type'], 'rank': h['rank']})
+        users = conn.execute("SELECT * FROM users").fetchall()
+        rank_list = []
+        for row in users:
+            t = row['money'] + row['bank_money'] + int(row['btc_amount'] * crypto_prices['비트코인'])
+            rank_list.append({'nick': row['nickname'], 'total': t})
+        rank_list.sort(key=lambda x: x['total'], reverse=True)
+        top_msg = "🏆 [제국 자산 랭킹 TOP 5]\n"
+        for i, r in enumerate(rank_list[:5], 1):
+            medal = "🥇" if i==1 else "🥈" if i==2 else "🥉" if i==3 else "🎖️"
+            top_msg += f"{medal} {i}위: {r['nick']} ({r['total']:,}₩)\n"
+        socketio.emit('message', {'msg': top_msg, 'type': 'system', 'total_asset': total}, room='main')
+
+@command("!저금", args=[('amount', pos_int, None)], usage="!저금 [금액]")
+def cmd_deposit(nick, amt):
+    u = get_user(nick)
+    if amt is None: amt = u['money']
+    if u['money'] >= amt and update_balances(nick, {'money': -amt, 'bank_money': amt}, 'deposit', require=('money', amt)):
+        u = get_user(nick) # 업데이트 후 다시 로드
+        emit('message', {'msg': f"🏦 {amt:,}₩ 저금됨", 'type': 'system', 'total_asset': asset_values(u)[1]})
+
+@command("!출금", args=[('amount', pos_int, None)], usage="!출금 [금액]")
+def cmd_withdraw(nick, amt):
+    u = get_user(nick)
+    if amt is None: amt = u['bank_money']
+    if u['bank_money'] >= amt and update_balances(nick, {'bank_money': -amt, 'money': amt}, 'withdraw', require=('bank_money', amt)):
+        u = get_user(nick)
+        emit('message', {'msg': f"💸 {amt:,}₩ 출금됨", 'type': 'system', 'total_asset': asset_values(u)[1]})
+
+@command("!매수", args=[('asset', str, REQUIRED), ('amount', pos_float, REQUIRED), ('price', pos_int, None)], rate='normal',
+         usage="!매수 비트코인 [금액] | !매수 비트코인 [수량] [지정가]")
+def cmd_buy(nick, asset, amount, price):
+    if price is not None: return limit_order(nick, 'buy', asset, amount, price)
+    # 지정가가 없으면 기존처럼 금액만큼 제국 시세로 바로 매수
+    amt = int(amount)
+    if not 0 < amt < 2 ** 63:
+        emit('message', {'msg': f"❓ 매수 금액은 1 ~ {2 ** 63 - 1:,}₩ 사이여야 합니다.", 'type': 'system'}); return
+    u = get_user(nick)
+    btc_add = amt / crypto_prices['비트코인']
+    if u['money'] >= amt and update_balances(nick, {'money': -amt, 'btc_amount': btc_add}, 'market_buy', require=('money', amt)):
+        u = get_user(nick)
+        emit('message', {'msg': f"🪙 비트코인 {btc_add:.8f}개 매수완료", 'type': 'system', 'total_asset': asset_values(u)[1]})
+        if amt >= 10000000:
+            broadcast_news(f"시장 요동! {nick}님이 비트코인을 {btc_add:.4f}개 쓸어담으며 '큰 손'으로 등극했습니다!")
+
+@command("!가위바위보", args=[('pick', str, REQUIRED), ('amount', pos_int, REQUIRED)], rate='normal', usage="!가위바위보 [가위/바위/보] [금액]")
+def cmd_rps(nick, pick, amt):
+    u = get_user(nick)
+    if u['money'] >= amt:
+        bot = random.choice(["가위", "바위", "보"])
+        if pick == bot: res = "무승부"
+        elif (pick=="가위" and bot=="보") or (pick=="바위" and bot=="가위") or (pick=="보" and bot=="바위"):
+            update_db(nick, "money", amt, 'rps'); res = f"승리! (+{amt:,}₩)"
+        elif update_balances(nick, {'money': -amt}, 'rps', require=('money', amt)): res = f"패배... (-{amt:,}₩)"
+        else: return  # 그 사이 다른 요청이 돈을 써버림
+        u = get_user(nick)
+        emit('message', {'msg': f"🎮 {pick} vs {bot} -> {res}", 'type': 'system', 'total_asset': asset_values(u)[1]})
+
+@command("!무한뇌절", rate='normal')
+def cmd_noejul(nick):
+    if noejul_loops.get(nick): return
+    noejul_loops[nick] = True
+    def task():
+        while noejul_loops.get(nick):
+            update_db(nick, "money", 5000, 'noejul')
+            socketio.emit('message', {'nickname': nick, 'msg': "🌀 뇌절 적립중...", 'type': 'noejul'}, room='main')
+            if random.random() < 0.1:
+                broadcast_news(f"{nick}님이 멈추지 않는 '무한 뇌절'로 시장 경제를 뒤흔들고 있습니다!")
+            time.sleep(2)
+    threading.Thread(target=task, daemon=True).start()
+
+@command("!뇌절정지", "!뇌절중단")
+def cmd_noejul_stop(nick):
+    noejul_loops[nick] = False
+
+@command("!gemini", args=[('prompt', REST, "")], rate='ai', usage="!gemini [질문]")
+def cmd_gemini(nick, prompt):
+    if not prompt:
+        emit('message', {'msg': "🤖 질문을 입력해주세요!", 'type': 'system'})
+    elif client is None:
+        emit('message', {'msg': "⚠️ Gemini API가 연결되지 않았습니다.", 'type': 'system'})
+    else:
+        try:
+            contents = build_gemini_contents('main', f"{nick}: {prompt}")
+            t0 = time.perf_counter()
+            try: res = client.models.generate_content(model=GEMINI_MODEL, contents=contents)
+            finally: observe('empire_gemini_seconds', time.perf_counter() - t0, kind='answer')
+            remember_turn('main', nick, prompt)
+            remember_turn('main', '🤖 Gemini AI', res.text)
+            socketio.emit('message', {
+                'nickname': '🤖 Gemini AI', 
+                'msg': res.text, 
+                'type': 'bot', 
+                'rank': '황실 책사'
+            }, room='main')
+        except Exception as e:
+            socketio.emit('message', {'msg': f"⚠️ Gemini 오류: {str(e)}", 'type': 'system'}, room='main')
+
+@command("!명령어")
+def cmd_help(nick):
+    usages = []
+    for spec in COMMANDS.values():
+        if spec['usage'] not in usages: usages.append(spec['usage'])
+    emit('message', {'msg': ", ".join(usages), 'type': 'system'})
+
+# --- [거래소: 지정가 호가창 + 체결 엔진] ---
+# 자산마다 매수(bids)/매도(asks) 힙으로 가격-시간 우선 체결을 합니다. (주문 id가 곧 접수 순서)
+# 주문을 넣을 때 매수는 현금, 매도는 코인을 먼저 묶어두고(escrow), 접수/체결/정산을 하나의 트랜잭션으로
+# 커밋하므로 중간에 실패해도 잔고가 어긋나지 않습니다. DB(orders)가 원본이며 메모리 호가창은 재시작 시 다시 만듭니다.
+SAT = 100_000_000                      # 수량은 1e-8 단위 정수로 계산 (부동소수 오차 방지)
+MAX_PRICE = 10 ** 12                   # 주문 한도: 가격 × 수량이 SQLite INTEGER 를 넘지 않게
+MAX_QTY = 1_000_000 * SAT
+ASSETS = {"비트코인": "btc_amount"}
+BOOK_DEPTH = 10
+order_books = {}
+
+def get_book(asset):
+    book = order_books.get(asset)
+    if book is None:
+        book = order_books[asset] = {'asset': asset, 'bids': [], 'asks': [], 'orders': {}, 'levels': {'buy': {}, 'sell': {}},
+                                     'last': None, 'lock': threading.Lock()}
+    return book
+
+def _level_add(book, side, price, dq, changed):
+    lv = book['levels'][side]
+    q = lv.get(price, 0) + dq
+    if q > 0: lv[price] = q
+    else: lv.pop(price, None)
+    changed.add((side, price))
+
+def _rest(book, o, changed):
+    """남은 수량을 호가창에 올립니다."""
+    book['orders'][o['id']] = o
+    if o['side'] == 'buy': heapq.heappush(book['bids'], (-o['price'], o['id']))
+    else: heapq.heappush(book['asks'], (o['price'], o['id']))
+    _level_add(book, o['side'], o['price'], o['remaining'], changed)
+
+def _best(book, side):
+    """최우선 호가 주문 (취소/체결 완료된 항목은 여기서 늦게 치움)"""
+    heap = book['bids'] if side == 'buy' else book['asks']
+    while heap and heap[0][1] not in book['orders']: heapq.heappop(heap)
+    return book['orders'][heap[0][1]] if heap else None
+
+def load_order_books():
+    with db_connect() as conn:
+        conn.row_factory = sqlite3.Row
+        rows = conn.execute("SELECT * FROM orders WHERE status = 'open' ORDER BY id").fetchall()
+    order_books.clear()
+    for r in rows:
+        _rest(get_book(r['asset']), dict(r), set())
+
+def _match(book, taker, deltas, touched, fills, changed):
+    """taker 주문을 반대편 호가와 체결시키고, 사용자별 잔고 변화를 deltas 에 모읍니다."""
+    opp = 'sell' if taker['side'] == 'buy' else 'buy'
+    while taker['remaining'] > 0:
+        maker = _best(book, opp)
+        if maker is None: break
+        if taker['side'] == 'buy' and maker['price'] > taker['price']: break
+        if taker['side'] == 'sell' and maker['price'] < taker['price']: break
+        q, px = min(taker['remaining'], maker['remaining']), maker['price']
+        cost = q * px // SAT
+        buyer, seller = (taker, maker) if taker['side'] == 'buy' else (maker, taker)
+        buyer['reserved'] -= cost
+        deltas.setdefault(buyer['nickname'], [0, 0.0])[1] += q / SAT
+        deltas.setdefault(seller['nickname'], [0, 0.0])[0] += cost
+        for o in (taker, maker): o['remaining'] -= q
+        _level_add(book, opp, px, -q, changed)
+        touched[maker['id']] = maker
+        fills.append((book['asset'], px, q, buyer['id'], seller['id']))
+        if maker['remaining'] == 0: book['orders'].pop(maker['id'])
+        book['last'] = px
+
+def _close_if_done(o, deltas):
+    """다 체결된 매수 주문은 지정가와 체결가 차이로 남은 현금을 돌려줍니다."""
+    if o['remaining'] == 0:
+        if o['side'] == 'buy' and o['reserved']:
+            deltas.setdefault(o['nickname'], [0, 0.0])[0] += o['reserved']
+            o['reserved'] = 0
+        o['status'] = 'filled'
+
+def apply_balance_deltas(conn, deltas, reason):
+    conn.executemany("UPDATE users SET money = money + ?, btc_amount = btc_amount + ? WHERE nickname = ?",
+                     [(m, b, n) for n, (m, b) in deltas.items()])
+    record_ledger(conn, [row for n, (m, b) in deltas.items() for row in ((n, 'money', m, reason), (n, 'btc_amount', b, reason))])
+
+def _save_orders(conn, orders):
+    conn.executemany("UPDATE orders SET remaining = ?, reserved = ?, status = ? WHERE id = ?",
+                     [(o['remaining'], o['reserved'], o['status'], o['id']) for o in orders])
+
+def place_order(nick, asset, side, qty, price):
+    """지정가 주문 접수 + 즉시 체결. (주문, 체결 목록) 또는 (None, 오류 메시지)"""
+    book, col = get_book(asset), ASSETS[asset]
+    changed = set()
+    with book['lock']:
+        conn = db_connect(timeout=10, isolation_level=None)
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            ensure_user(conn, nick)
+            if side == 'buy':
+                reserved = -(-qty * price // SAT)  # 올림: 체결 금액 합계가 예치금을 넘지 않도록
+                ok = conn.execute("UPDATE users SET money = money - ? WHERE nickname = ? AND money >= ?", (reserved, nick, reserved)).rowcount
+            else:
+                reserved = 0
+                ok = conn.execute(f"UPDATE users SET {col} = {col} - ? WHERE nickname = ? AND {col} >= ?", (qty / SAT, nick, qty / SAT)).rowcount
+            if not ok:
+                conn.execute("ROLLBACK")
+                return None, "💸 잔고가 부족합니다."
+            record_ledger(conn, [(nick, 'money', -reserved, 'order_escrow') if side == 'buy' else (nick, col, -qty / SAT, 'order_escrow')])
+            oid = conn.execute("INSERT INTO orders (nickname, asset, side, price, qty, remaining, reserved) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                               (nick, asset, side, price, qty, qty, reserved)).lastrowid
+            taker = {'id': oid, 'nickname': nick, 'asset': asset, 'side': side, 'price': price, 'qty': qty,
+                     'remaining': qty, 'reserved': reserved, 'status': 'open'}
+            deltas, touched, fills = {}, {}, []
+            _match(book, taker, deltas, touched, fills, changed)
+            for o in [taker, *touched.values()]: _close_if_done(o, deltas)
+            apply_balance_deltas(conn, deltas, 'trade')
+            _save_orders(conn, [taker, *touched.values()])
+            conn.executemany("INSERT INTO trades (asset, price, qty, buy_order, sell_order) VALUES (?, ?, ?, ?, ?)", fills)
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            load_order_books()  # 메모리 호가창을 DB 기준으로 되돌림
+            raise
+        finally:
+            conn.close()
+        if taker['remaining'] > 0: _rest(book, taker, changed)
+    publish_book_changes(asset, changed)
+    return taker, fills
+
+def cancel_order(nick, oid):
+    for asset, book in order_books.items():
+        with book['lock']:
+            o = book['orders'].get(oid)
+            if not o: continue
+            if o['nickname'] != nick: return None
+            refund = [o['reserved'], 0.0] if o['side'] == 'buy' else [0, o['remaining'] / SAT]
+            with db_connect(timeout=10) as conn:
+                apply_balance_deltas(conn, {nick: refund}, 'order_cancel')
+                conn.execute("UPDATE orders SET status = 'cancelled', reserved = 0 WHERE id = ?", (oid,))
+            book['orders'].pop(oid)
+            changed = set()
+            _level_add(book, o['side'], o['price'], -o['remaining'], changed)
+        publish_book_changes(asset, changed)
+        return o
+    return None
+
+def book_depth(asset, n=BOOK_DEPTH):
+    book = get_book(asset)
+    with book['lock']:
+        bids = sorted(book['levels']['buy'].items(), reverse=True)[:n]
+        asks = sorted(book['levels']['sell'].items())[:n]
+        return {'asset': asset, 'bids': bids, 'asks': asks, 'last': book['last']}
+
+def publish_book_changes(asset, changed):
+    """바뀐 가격대만 보내는 증분 호가 갱신 (+ 최우선 매수/매도호가)"""
+    if not changed: return
+    book = get_book(asset)
+    with book['lock']:
+        levels = book['levels']
+        diff = [[side, price, levels[side].get(price, 0)] for side, price in sorted(changed)]
+        bid, ask = _best(book, 'buy'), _best(book, 'sell')
+        payload = {'asset': asset, 'changes': diff, 'bid': bid and bid['price'], 'ask': ask and ask['price'], 'last': book['last']}
+    socketio.emit('book_update', payload, room='main')
+
+def fmt_qty(q): return f"{q / SAT:.8f}".rstrip('0').rstrip('.')
+
+def to_sat(amount):
+    if not math.isfinite(amount): raise ValueError(amount)
+    return int(round(amount * SAT))
+
+def _order_result(nick, side, asset, order, fills):
+    filled = order['qty'] - order['remaining']
+    label = "매수" if side == 'buy' else "매도"
+    msg = f"📝 [{label} 주문 #{order['id']}] {asset} {fmt_qty(order['qty'])}개 @ {order['price']:,}₩"
+    if filled:
+        avg = sum(px * q for _, px, q, _, _ in fills) // filled
+        msg += f"\n✅ 체결 {fmt_qty(filled)}개 (평균 {avg:,}₩)"
+    if order['remaining']:
+        msg += f"\n⏳ 미체결 {fmt_qty(order['remaining'])}개 호가 대기중 (!주문취소 {order['id']})"
+    emit('message', {'msg': msg, 'type': 'system', 'total_asset': asset_values(get_user(nick))[1]})
+    if fills:
+        socketio.emit('message', {'msg': f"💱 {asset} {fmt_qty(filled)}개 체결 @ {fills[-1][1]:,}₩", 'type': 'system'}, room='main')
+
+def limit_order(nick, side, asset, amount, price):
+    if asset not in ASSETS:
+        emit('message', {'msg': f"❓ 거래할 수 없는 자산입니다: {asset}", 'type': 'system'}); return
+    qty = to_sat(amount)
+    if not (0 < qty <= MAX_QTY and 0 < price <= MAX_PRICE):
+        emit('message', {'msg': f"❓ 수량은 0보다 크고 {fmt_qty(MAX_QTY)}개 이하, 가격은 1~{MAX_PRICE:,}₩ 이어야 합니다.", 'type': 'system'}); return
+    order, fills = place_order(nick, asset, side, qty, price)
+    if order is None:
+        emit('message', {'msg': fills, 'type': 'system'}); return
+    _order_result(nick, side, asset, order, fills)
+
+@command("!매도", args=[('asset', str, REQUIRED), ('amount', pos_float, REQUIRED), ('price', pos_int, None)], rate='normal',
+         usage="!매도 비트코인 [수량] [지정가]")
+def cmd_sell(nick, asset, amount, price):
+    if price is not None: return limit_order(nick, 'sell', asset, amount, price)
+    # 지정가가 없으면 제국 시세로 바로 매도
+    if amount > MAX_QTY / SAT:
+        emit('message', {'msg': f"❓ 한 번에 {fmt_qty(MAX_QTY)}개까지 매도할 수 있습니다.", 'type': 'system'}); return
+    gain = int(amount * crypto_prices['비트코인'])
+    if asset in ASSETS and amount > 0 and update_balances(nick, {'btc_amount': -amount, 'money': gain}, 'market_sell', require=('btc_amount', amount)):
+        u = get_user(nick)
+        emit('message', {'msg': f"🪙 비트코인 {amount:.8f}개 매도완료 (+{gain:,}₩)", 'type': 'system', 'total_asset': asset_values(u)[1]})
+
+@command("!주문취소", args=[('order_id', pos_int, REQUIRED)], usage="!주문취소 [주문번호]")
+def cmd_cancel(nick, oid):
+    o = cancel_order(nick, oid)
+    if o is None:
+        emit('message', {'msg': f"❓ 취소할 수 있는 내 주문 #{oid} 이(가) 없습니다.", 'type': 'system'}); return
+    emit('message', {'msg': f"🗑️ 주문 #{oid} 취소 (미체결 {fmt_qty(o['remaining'])}개 반환)", 'type': 'system',
+                     'total_asset': asset_values(get_user(nick))[1]})
+
+@command("!호가", args=[('asset', str, "비트코인")], usage="!호가 [자산]")
+def cmd_book(nick, asset):
+    if asset not in ASSETS:
+        emit('message', {'msg': f"❓ 거래할 수 없는 자산입니다: {asset}", 'type': 'system'}); return
+    d = book_depth(asset, 5)
+    lines = [f"📊 [{asset} 호가창]"]
+    lines += [f"  매도 {p:,}₩ | {fmt_qty(q)}" for p, q in reversed(d['asks'])] or ["  (매도 호가 없음)"]
+    lines.append("  ─────────")
+    lines += [f"  매수 {p:,}₩ | {fmt_qty(q)}" for p, q in d['bids']] or ["  (매수 호가 없음)"]
+    emit('message', {'msg': "\n".join(lines), 'type': 'system'})
+
+load_order_books()
+
+# --- [송금: 두 계좌(또는 여러 계좌)를 한 트랜잭션으로] ---
+# update_db 를 두 번 부르면 트랜잭션이 둘로 나뉘어 중간 상태가 보이고 잔액 확인도 경쟁에 집니다.
+# 송금은 BEGIN IMMEDIATE 한 번 안에서 "잔액이 충분할 때만 차감" + 입금을 처리합니다.
+# 같은 계좌를 건드리는 송금끼리는 계좌 잠금(닉네임 해시로 나눈 줄무늬 잠금)을 항상 번호 순으로 잡아
+# 서로 반대 방향 송금(A→B, B→A)이 동시에 와도 교착되지 않고, 서로 다른 계좌끼리는 DB 쓰기 순간만 겹칩니다.
+ACCOUNT_STRIPES = 64
+account_locks = [threading.Lock() for _ in range(ACCOUNT_STRIPES)]
+TRANSFER_MAX_RECIPIENTS = 20
+
+def _account_lock_ids(nicks):
+    return sorted({hash(n) % ACCOUNT_STRIPES for n in nicks})
+
+def transfer(payer, payouts):
+    """payer 가 payouts [(받는 사람, 금액), ...] 에게 한 번에 송금합니다. (성공 여부, 메시지)"""
+    total = sum(a for _, a in payouts)
+    ids = _account_lock_ids([payer, *(n for n, _ in payouts)])
+    for i in ids: account_locks[i].acquire()
+    try:
+        conn = db_connect(timeout=10, isolation_level=None)
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            names = [n for n, _ in payouts]
+            found = {r[0] for r in conn.execute(f"SELECT nickname FROM users WHERE nickname IN ({','.join('?' * len(names))})", names)}
+            missing = [n for n in names if n not in found]
+            if missing:
+                conn.execute("ROLLBACK")
+                return False, f"❓ 존재하지 않는 유저: {', '.join(missing)}"
+            if not conn.execute("UPDATE users SET money = money - ? WHERE nickname = ? AND money >= ?", (total, payer, total)).rowcount:
+                conn.execute("ROLLBACK")
+                return False, f"💸 잔액이 부족합니다. (필요: {total:,}₩)"
+            conn.executemany("UPDATE users SET money = money + ? WHERE nickname = ?", [(a, n) for n, a in payouts])
+            record_ledger(conn, [(payer, 'money', -total, 'transfer_out'), *((n, 'money', a, 'transfer_in') for n, a in payouts)])
+            conn.execute("COMMIT")
+            return True, None
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        finally:
+            conn.close()
+    finally:
+        for i in reversed(ids): account_locks[i].release()
+
+@command("!송금", args=[('targets', REST, REQUIRED)], rate='normal', usage="!송금 [닉네임] [금액] ([닉네임] [금액] ...)")
+def cmd_transfer(nick, targets):
+    tokens = targets.split()
+    try:
+        payouts = [(tokens[i], pos_int(tokens[i + 1])) for i in range(0, len(tokens), 2)]
+    except (IndexError, ValueError):
+        payouts = []
+    if not payouts or len(payouts) > TRANSFER_MAX_RECIPIENTS or any(a <= 0 or n == nick for n, a in payouts) \
+            or len({n for n, _ in payouts}) != len(payouts):
+        emit('message', {'msg': f"❓ 사용법: !송금 [닉네임] [금액] (최대 {TRANSFER_MAX_RECIPIENTS}명, 자기 자신/중복 제외)", 'type': 'system'})
+        return
+    get_user(nick)
+    ok, err = transfer(nick, payouts)
+    if not ok:
+        emit('message', {'msg': err, 'type': 'system'}); return
+    emit('message', {'msg': f"💸 송금 완료: {sum(a for _, a in payouts):,}₩", 'type': 'system', 'total_asset': asset_values(get_user(nick))[1]})
+    detail = ", ".join(f"{n} {a:,}₩" for n, a in payouts)
+    socketio.emit('message', {'msg': f"💌 {nick}님이 송금했습니다 → {detail}", 'type': 'system'}, room='main')
 
 @socketio.on('send_msg')
+@profile_hook
 def handle_msg(data):
-    # 1. 기본 데이터 추출 및 유저 정보 로드
+    # 1. 기본 데이터 추출 후 명령어면 등록부로 바로 보냄 (보상/채팅 기록 없음)
     nick, raw = data['nickname'], data['msg'].strip()
     if not raw: return
-    
-    u = get_user(nick)
-    
+    spec = COMMANDS.get(raw.split(maxsplit=1)[0])
+    name = spec['name'] if spec else 'chat'
+    t0 = time.perf_counter()
+    try:
+        with trace('send_msg', nick=nick, command=name, length=len(raw)):
+            if spec: run_command(spec, nick, raw)
+            else: handle_chat(nick, raw)
+    finally:
+        observe('empire_send_msg_seconds', time.perf_counter() - t0, command=name)
+
+def handle_chat(nick, raw):
+    with span('get_user'): u = get_user(nick)
+
     # 2. 메시지 보상 계산 및 DB 업데이트
     if len(raw) > 500:
-        fname = f"msg_{int(time.time())}.txt"
-        path = os.path.join(UPLOAD_FOLDER, fname)
-        with open(path, "w", encoding="utf-8") as f: f.write(raw)
+        with span('save_text_upload', length=len(raw)):
+            fname = save_text_upload(nick, raw, f"msg_{int(time.time())}.txt")
         reward = len(raw) * 100 
-        update_db(nick, "money", reward)
-        raw = f"📄 대용량 메시지 감지 (파일 변환)\n🔗 다운로드: {request.host_url.rstrip('/')}/uploads/{fname}"
+        raw = f"📄 대용량 메시지 감지 (파일 변환)\n{text_preview(raw)}\n🔗 다운로드: {request.host_url.rstrip('/')}/uploads/{fname}"
     else:
         reward = len(raw) * 50
-        update_db(nick, "money", reward)
+    with span('update_db'): update_db(nick, "money", reward, 'chat')
 
     if reward >= 100000:
         broadcast_news(f"현재 {nick}님이 대용량 메시지 전송으로 {reward:,}₩의 막대한 부를 쌓고 있습니다!")
 
-    # [중요] 보상 수령 후 최신 유저 정보와 자산 다시 계산
-    u = get_user(nick)
-    btc_v = int(u['btc_amount'] * crypto_prices['비트코인'])
-    total = u['money'] + u['bank_money'] + btc_v
+    # 보상 반영 후 자산 (다시 조회하지 않고 방금 더한 값으로 계산)
+    u['money'] += reward
+    total = asset_values(u)[1]
 
-    parts = raw.split()
-    cmd = parts[0]
+    # 3. 일반 채팅 메시지 처리
+    rank = rank_of(total)
     
-    # --- 명령어 처리부 ---
+    with span('insert_chat'), db_connect() as conn:
+        conn.execute("INSERT INTO chats (nickname, msg, type, rank) VALUES (?, ?, ?, ?)", (nick, raw, 'chat', rank))
+    with span('remember_turn'): remember_turn('main', nick, raw)
     
-    if cmd == "!잔액":
-        res = f"💰 {nick}님 자산\n💵 현금: {u['money']:,}₩\n🏦 은행: {u['bank_money']:,}₩\n🪙 코인: {btc_v:,}₩\n💳 총액: {total:,}₩"
-        emit('message', {'msg': res, 'type': 'system', 'total_asset': total})
-    
-    elif cmd == "!랭킹":
-        with sqlite3.connect(DB_FILE) as conn:
-            conn.row_factory = sqlite3.Row
-            users = conn.execute("SELECT * FROM users").fetchall()
-            rank_list = []
-            for row in users:
-                t = row['money'] + row['bank_money'] + int(row['btc_amount'] * crypto_prices['비트코인'])
-                rank_list.append({'nick': row['nickname'], 'total': t})
-            rank_list.sort(key=lambda x: x['total'], reverse=True)
-            top_msg = "🏆 [제국 자산 랭킹 TOP 5]\n"
-            for i, r in enumerate(rank_list[:5], 1):
-                medal = "🥇" if i==1 else "🥈" if i==2 else "🥉" if i==3 else "🎖️"
-                top_msg += f"{medal} {i}위: {r['nick']} ({r['total']:,}₩)\n"
-            socketio.emit('message', {'msg': top_msg, 'type': 'system', 'total_asset': total}, room='main')
-
-    elif cmd == "!저금":
-        amt = int(parts[1]) if len(parts)>1 else u['money']
-        if u['money'] >= amt: 
-            update_db(nick, "money", -amt); update_db(nick, "bank_money", amt)
-            u = get_user(nick) # 업데이트 후 다시 로드
-            total = u['money'] + u['bank_money'] + btc_v
-            emit('message', {'msg': f"🏦 {amt:,}₩ 저금됨", 'type': 'system', 'total_asset': total})
-
-    elif cmd == "!출금":
-        amt = int(parts[1]) if len(parts)>1 else u['bank_money']
-        if u['bank_money'] >= amt: 
-            update_db(nick, "bank_money", -amt); update_db(nick, "money", amt)
-            u = get_user(nick)
-            total = u['money'] + u['bank_money'] + btc_v
-            emit('message', {'msg': f"💸 {amt:,}₩ 출금됨", 'type': 'system', 'total_asset': total})
-
-    elif cmd == "!매수" and len(parts)>2:
-        amt = int(parts[2])
-        if u['money'] >= amt:
-            btc_add = amt / crypto_prices['비트코인']
-            update_db(nick, "money", -amt); update_db(nick, "btc_amount", btc_add)
-            u = get_user(nick)
-            total = u['money'] + u['bank_money'] + int(u['btc_amount'] * crypto_prices['비트코인'])
-            emit('message', {'msg': f"🪙 비트코인 {btc_add:.8f}개 매수완료", 'type': 'system', 'total_asset': total})
-            if amt >= 10000000:
-                broadcast_news(f"시장 요동! {nick}님이 비트코인을 {btc_add:.4f}개 쓸어담으며 '큰 손'으로 등극했습니다!")
-
-    elif cmd == "!가위바위보" and len(parts)>2:
-        pick, amt = parts[1], int(parts[2])
-        if u['money'] >= amt:
-            bot = random.choice(["가위", "바위", "보"])
-            if pick == bot: res = "무승부"
-            elif (pick=="가위" and bot=="보") or (pick=="바위" and bot=="가위") or (pick=="보" and bot=="바위"):
-                update_db(nick, "money", amt); res = f"승리! (+{amt:,}₩)"
-            else: update_db(nick, "money", -amt); res = f"패배... (-{amt:,}₩)"
-            u = get_user(nick)
-            total = u['money'] + u['bank_money'] + int(u['btc_amount'] * crypto_prices['비트코인'])
-            emit('message', {'msg': f"🎮 {pick} vs {bot} -> {res}", 'type': 'system', 'total_asset': total})
-
-    elif cmd == "!무한뇌절":
-        if noejul_loops.get(nick): return
-        noejul_loops[nick] = True
-        def task():
-            while noejul_loops.get(nick):
-                update_db(nick, "money", 5000)
-                socketio.emit('message', {'nickname': nick, 'msg': "🌀 뇌절 적립중...", 'type': 'noejul'}, room='main')
-                if random.random() < 0.1:
-                    broadcast_news(f"{nick}님이 멈추지 않는 '무한 뇌절'로 시장 경제를 뒤흔들고 있습니다!")
-                time.sleep(2)
-        threading.Thread(target=task, daemon=True).start()
-
-    elif cmd in ["!뇌절정지", "!뇌절중단"]: noejul_loops[nick] = False
-
-    elif cmd == "!gemini":
-        prompt = " ".join(parts[1:])
-        if not prompt:
-            emit('message', {'msg': "🤖 질문을 입력해주세요!", 'type': 'system', 'total_asset': total})
-        elif client is None:
-            emit('message', {'msg': "⚠️ Gemini API가 연결되지 않았습니다.", 'type': 'system', 'total_asset': total})
-        else:
-            try:
-                res = client.models.generate_content(model="gemini-2.0-flash", contents=prompt)
-                socketio.emit('message', {
-                    'nickname': '🤖 Gemini AI', 
-                    'msg': res.text, 
-                    'type': 'bot', 
-                    'rank': '황실 책사'
-                }, room='main')
-            except Exception as e:
-                socketio.emit('message', {'msg': f"⚠️ Gemini 오류: {str(e)}", 'type': 'system'}, room='main')
-
-    elif cmd == "!명령어":
-        emit('message', {'msg': "!잔액, !랭킹, !저금 [금액], !출금 [금액], !가위바위보 [패] [금액], !매수 비트코인 [금액], !무한뇌절, !뇌절중단, !gemini [질문]", 'type': 'system', 'total_asset': total})
-
-    # 4. 일반 채팅 메시지 처리 (중복 전송 버그 수정됨)
-    else:
-        if total >= 200000000: rank = "멀티버스 지배자"
-        elif total >= 10000000: rank = "초월자"
-        else: rank = "평민"
-        
-        with sqlite3.connect(DB_FILE) as conn:
-            conn.execute("INSERT INTO chats (nickname, msg, type, rank) VALUES (?, ?, ?, ?)", (nick, raw, 'chat', rank))
-        
-        # [수정] 단 한 번만 전송하며 total_asset을 포함합니다.
+    # [수정] 단 한 번만 전송하며 total_asset을 포함합니다.
+    with span('emit', fanout=connected_clients):
         socketio.emit('message', {
             'nickname': nick, 
             'msg': raw, 
@@ -250,4 +2160,14 @@ def handle_msg(data):
         }, room='main')
         
 if __name__ == '__main__':
-    socketio.run(app, debug=True, port=PORT, host='0.0.0.0')
+    # python 서버.py export > dump.jsonl  /  python 서버.py import dump.jsonl [skip|replace]
+    if sys.argv[1:2] == ['export']:
+        for line in export_jsonl(): sys.stdout.write(line)
+        sys.exit()
+    if sys.argv[1:2] == ['import']:
+        with open(sys.argv[2], encoding='utf-8') as f: counts = import_jsonl(f, sys.argv[3] if len(sys.argv) > 3 else 'skip')
+        if counts.get('users'): snapshot_balances(everyone=True)  # /admin/import 와 같이 가져온 잔액을 원장 기준으로
+        print(counts)
+        sys.exit()
+    debug = os.environ.get('EMPIRE_DEBUG', '1') == '1'  # 부하 측정(loadgen.py --spawn) 때는 0
+    socketio.run(app, debug=debug, port=PORT, host='0.0.0.0', allow_unsafe_werkzeug=True)
@@ -1,9 +1,11 @@
 import sqlite3
 import os
 import time
+import uuid
 import threading
 import random
-from flask import Flask, render_template, request, send_from_directory, url_for
+import gzip
+from flask import Flask, render_template, request, send_from_directory, url_for, Response
 from flask_socketio import SocketIO, emit, join_room
 from werkzeug.utils import secure_filename
 
@@ -77,11 +79,17 @@ def noejul_task(nick):
         time.sleep(3)
 
 def save_large_text(nick, content):
-    filename = f"DATA_{int(time.time())}_{nick}.txt"
-    filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-    with open(filepath, "w", encoding="utf-8") as f: f.write(content)
+    # 대용량 텍스트는 gzip으로 압축해 DATA_...txt.gz 로 저장 (링크는 .txt 그대로)
+    # 한글 닉네임은 secure_filename 이 빈 문자열이 되므로 uuid 로 이름이 겹치지 않게 함
+    filename = f"DATA_{int(time.time())}_{uuid.uuid4().hex[:12]}_{secure_filename(nick)}.txt"
+    filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename + ".gz")
+    with gzip.open(filepath, "wt", encoding="utf-8", compresslevel=6) as f: f.write(content)
     return url_for('download_file', filename=filename, _external=True)
 
+def text_preview(content, limit=200, max_lines=4):
+    preview = "\n".join(content[:limit].splitlines()[:max_lines])
+    return preview + ("…" if len(preview) < len(content) else "")
+
 # --- [4. 이벤트 처리] ---
 @app.route('/')
 def index(): return render_template('index.html')
@@ -98,7 +106,21 @@ def upload_file():
     return 'Fail', 400
 
 @app.route('/uploads/<filename>')
-def download_file(filename): return send_from_directory(app.config['UPLOAD_FOLDER'], filename)
+def download_file(filename):
+    gz_path = os.path.join(app.config['UPLOAD_FOLDER'], secure_filename(filename) + ".gz")
+    if not os.path.exists(gz_path):
+        return send_from_directory(app.config['UPLOAD_FOLDER'], filename)
+    # 압축 저장된 텍스트: gzip을 받는 클라이언트엔 그대로 보내고, 아니면 즉석에서 풀어서 보냄
+    if request.accept_encodings['gzip'] > 0:
+        resp = send_from_directory(app.config['UPLOAD_FOLDER'], filename + ".gz", mimetype="text/plain", download_name=filename)
+        resp.headers['Content-Encoding'] = 'gzip'
+    else:
+        def stream():
+            with gzip.open(gz_path, 'rb') as f:
+                for buf in iter(lambda: f.read(64 * 1024), b''): yield buf
+        resp = Response(stream(), mimetype="text/plain")
+    resp.vary.add('Accept-Encoding')
+    return resp
 
 @socketio.on('join')
 def on_join(data):
@@ -118,7 +140,7 @@ def handle_msg(data):
     display_msg = msg
     if msg_len > 800: # 대용량 메세지 처리
         link = save_large_text(nick, msg)
-        display_msg = f"📄 [대용량 데이터 저장 완료]\n길이: {msg_len}자 | 적립: {reward}₩\n🔗 링크: {link}"
+        display_msg = f"📄 [대용량 데이터 저장 완료]\n길이: {msg_len}자 | 적립: {reward}₩\n{text_preview(msg)}\n🔗 링크: {link}"
 
     parts = msg.split()
     cmd = parts[0].lower() if msg.startswith("!") else ""